@@ -1,51 +1,262 @@
 from dotenv import load_dotenv
 import os
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import functools
+import httpx
 import json
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from completion_cache import CompletionCache, MemoryCache, SQLiteCache, cache_key, message_text
 
 # Load .env file
 load_dotenv()
 
 def undef(*args, **kwargs): print("function undefined")
 
+# An input like '1B' is output B of step 1
+STEP_REFERENCE = re.compile(r"^(\d+)([A-Z])$")
+
+PLAN_INSTRUCTION = "Create a plan to accomplish the objective utilizing only the available tools. Your response should be formatted as a JSON, with numbered fields for each of the steps. If you do not have enough tools, the 'FAILURE' field should be 'TRUE' and the 'REASON' field should have an explanation of why you don't have enough tools, otherwise 'FAILURE' should be 'FALSE' and 'REASON' should be blank. Every numbered step should have several fields: One for 'TOOL_NAME', and one for each of the input variables required (X,Y,Z). It should also have an 'OUTPUTS' field with each of the output names (A,B,C) and their description. If a tool needs the output of a previous tool as it's input, you can put the step number followed by the variable name. For example, to get the top search results from step one if you used the 'browser' tool, you would use '1B' as the input value.\n\n The final step should ALWAYS be to use the `to_user` function to print a response to the user. The last field should be a 'STEPS' field with the total number of steps."
+
+@functools.lru_cache(maxsize=32)
+def system_message(system, tasks):
+    # Built once per instruction and tool catalog, so every request starts with the very same system message.
+    # The instruction comes before the catalog and the prompt comes last, which keeps the shared prefix that
+    # server-side prompt caching matches on as long as possible. Callers must not modify it.
+    return {"role": "system", "content": system + tasks}
+
 # Step 1: Configuration
 class Config:
     def __init__(self):
         self.api_key = os.getenv('OPENAI_API')
         openai.api_key = self.api_key
+        # Completions are cached in this SQLite file, unless AGENT_CACHE_BYPASS is set for non-deterministic runs
+        self.cache_path = os.getenv('AGENT_CACHE', '.completion-cache.sqlite')
+        self.cache_bypass = bool(os.getenv('AGENT_CACHE_BYPASS'))
 
 # Step 2: Agent Class
 class Agent:
-    def __init__(self, config, model='gpt-4o'):
+    def __init__(self, config, model='gpt-4o', cache=None):
         self.config = config
         self.client = OpenAI()
         self.client.api_key = self.config.api_key
         self.model = "gpt-4o"
+        self.cache = cache
 
     def format_messages(self, system, tasks, prompt):
         messages = [
-                {
-                    "role": "system",
-                    "content": [{
-                        "type": "text",
-                        "text": system + tasks
-                }]},
+                system_message(system, tasks),
                 {
                     "role": "user",
-                    "content": [{
-                        "type": "text",
-                        "text": prompt
-                }]}
+                    "content": prompt
+                }
         ]
         return messages
 
-    def generate_response(self, messages):
+    def cached_response(self, messages, parameters):
+        # Returns the cache key of the request and the cached completion, or None
+        if self.cache is None:
+            return None, None
+        key = cache_key(self.model, messages, parameters)
+        return key, self.cache.get(key)
+
+    def generate_response(self, messages, **parameters):
+        key, content = self.cached_response(messages, parameters)
+        if content is not None:
+            return content
         response = self.client.chat.completions.create(
             model=self.model,
-            messages=messages
+            messages=messages,
+            **parameters
+        )
+        content = response.choices[0].message.content
+        if key is not None and content is not None:
+            self.cache.put(key, content)
+        return content
+
+    def stream_response(self, messages, **parameters):
+        # Yields the text of the response as it is generated, or all at once when it is cached
+        key, content = self.cached_response(messages, parameters)
+        if content is not None:
+            yield content
+            return
+        stream = self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            **parameters
+        )
+        chunks = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        if key is not None and chunks:
+            self.cache.put(key, "".join(chunks))
+
+class TokenBucket:
+    # Holds up to capacity tokens and refills at rate tokens per second. Waiters are served in arrival order.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)  # A request bigger than the bucket waits for a full one
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+class AsyncAgent(Agent):
+    # Sends completions concurrently over one AsyncOpenAI client, and so one HTTP connection pool.
+    # At most max_concurrency requests are in flight, and requests_per_minute and tokens_per_minute,
+    # when given, are enforced with token buckets. Tokens are estimated at 4 characters each.
+    def __init__(self, config, model='gpt-4o', max_concurrency=8, requests_per_minute=None, tokens_per_minute=None, cache=None):
+        self.config = config
+        self.model = model
+        self.cache = cache
+        self.client = AsyncOpenAI(
+            api_key=self.config.api_key,
+            http_client=openai.DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency))
         )
-        return response.choices[0].message.content
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute / 60, requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+
+    def estimate_tokens(self, messages):
+        characters = sum(len(message_text(message["content"])) for message in messages)
+        return characters // 4 + 1
+
+    async def generate_response(self, messages, **parameters):
+        key, content = self.cached_response(messages, parameters)
+        if content is not None:
+            return content
+        async with self.semaphore:
+            # Waiting for the buckets inside the semaphore only spends them on requests that are about to go out
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire()
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(self.estimate_tokens(messages))
+            response = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                **parameters
+            )
+        content = response.choices[0].message.content
+        if key is not None and content is not None:
+            self.cache.put(key, content)
+        return content
+
+    async def stream_response(self, messages, **parameters):
+        # Async generator of the text of the response as it is generated, or all at once when it is cached.
+        # The request holds its place in max_concurrency until the whole response has arrived.
+        key, content = self.cached_response(messages, parameters)
+        if content is not None:
+            yield content
+            return
+        chunks = []
+        async with self.semaphore:
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire()
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(self.estimate_tokens(messages))
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                **parameters
+            )
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    chunks.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        if key is not None and chunks:
+            self.cache.put(key, "".join(chunks))
+
+    async def generate_responses(self, message_lists):
+        # Responses come back in the order of the message lists
+        return await asyncio.gather(*[self.generate_response(messages) for messages in message_lists])
+
+    async def close(self):
+        await self.client.close()
+
+class PlanStreamParser:
+    # Incremental parser for a plan that is still being generated. feed() takes the text as it arrives and returns
+    # the (key, value) pairs of the plan's top-level object that it completed, a step as soon as its closing brace
+    # arrives. Text around the object, like a Markdown code fence, is skipped. Every character is scanned once.
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.member_start = None
+        self.done = False
+
+    def feed(self, text):
+        self.buffer += text
+        members = []
+        while self.position < len(self.buffer) and not self.done:
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif self.depth == 0:
+                if char == "{":
+                    self.depth = 1
+                    self.member_start = self.position + 1
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 1:
+                    # A step, or another nested value, is complete without waiting for the next comma
+                    self.emit(self.position + 1, members)
+                elif self.depth == 0:
+                    self.emit(self.position, members)
+                    self.done = True
+            elif char == "," and self.depth == 1:
+                self.emit(self.position, members)
+                self.member_start = self.position + 1
+            self.position += 1
+        # Only the member being generated is kept
+        keep = self.member_start if self.member_start is not None else self.position
+        self.buffer = self.buffer[keep:]
+        self.position -= keep
+        if self.member_start is not None:
+            self.member_start = 0
+        return members
+
+    def emit(self, end, members):
+        if self.member_start is None:
+            return
+        text = self.buffer[self.member_start:end].strip()
+        self.member_start = None
+        if text:
+            members.extend(json.loads("{" + text + "}").items())
+
+    def close(self):
+        if not self.done:
+            raise ValueError("The plan ended before its closing brace")
 
 # Step 3: Tasks
 class Task:
@@ -59,41 +270,205 @@ class Task:
 
 # Step 4: Task Handlers
 class TaskHandler:
-    def __init__(self, agent, tasks):
+    def __init__(self, agent, tasks, max_workers=8):
         self.agent = agent
         self.tasks = {task.name: task for task in tasks}
+        self.max_workers = max_workers
+        self.catalog = None  # Rendered task_list(), reset whenever tasks are registered or removed
+
+    def register_task(self, task):
+        self.tasks[task.name] = task
+        self.catalog = None
+
+    def remove_task(self, name):
+        self.tasks.pop(name, None)
+        self.catalog = None
 
-    def plan_tasks(self, prompt):
-        messages = self.agent.format_messages("Create a plan to accomplish the objective utilizing only the available tools. Your response should be formatted as a JSON, with numbered fields for each of the steps. If you do not have enough tools, the 'FAILURE' field should be 'TRUE' and the 'REASON' field should have an explanation of why you don't have enough tools, otherwise 'FAILURE' should be 'FALSE' and 'REASON' should be blank. Every numbered step should have several fields: One for 'TOOL_NAME', and one for each of the input variables required (X,Y,Z). It should also have an 'OUTPUTS' field with each of the output names (A,B,C) and their description. If a tool needs the output of a previous tool as it's input, you can put the step number followed by the variable name. For example, to get the top search results from step one if you used the 'browser' tool, you would use '1B' as the input value.\n\n The final step should ALWAYS be to use the `to_user` function to print a response to the user. The last field should be a 'STEPS' field with the total number of steps.", self.task_list(), prompt)
-        task_plan = self.agent.generate_response(messages)
+    def plan_messages(self, prompt):
+        return self.agent.format_messages(PLAN_INSTRUCTION, self.task_list(), prompt)
+
+    def parse_plan(self, task_plan):
         if task_plan.startswith("```json\n"):
             task_plan = task_plan[len("```json\n"):]
         if task_plan.endswith("```"):
             task_plan = task_plan[:-len("```")]
         return json.loads(task_plan)
 
+    def stream_plan(self, chunks):
+        parser = PlanStreamParser()
+        for chunk in chunks:
+            yield from parser.feed(chunk)
+        parser.close()
+
+    def plan_tasks(self, prompt, stream=False):
+        # With stream, returns an iterator over the (key, value) pairs of the plan, each as soon as it is generated
+        if isinstance(self.agent, AsyncAgent):
+            raise TypeError("An AsyncAgent plans with plan_tasks_async or stream_plan_async")
+        if stream:
+            return self.stream_plan(self.agent.stream_response(self.plan_messages(prompt)))
+        return self.parse_plan(self.agent.generate_response(self.plan_messages(prompt)))
+
+    async def stream_plan_async(self, prompt):
+        # Async generator of the (key, value) pairs of the plan, each as soon as it is generated. Needs an AsyncAgent.
+        parser = PlanStreamParser()
+        async for chunk in self.agent.stream_response(self.plan_messages(prompt)):
+            for member in parser.feed(chunk):
+                yield member
+        parser.close()
+
+    async def plan_tasks_async(self, prompts):
+        # Plans every prompt at once. Needs an AsyncAgent.
+        responses = await self.agent.generate_responses([self.plan_messages(prompt) for prompt in prompts])
+        return [self.parse_plan(response) for response in responses]
+
     def lint_tasks(self, task_plan):
         return True
 
+    def step_inputs(self, step):
+        return {key: value for key, value in step.items() if key not in ("TOOL_NAME", "OUTPUTS")}
+
+    def references(self, value):
+        # Yields the (step, output) of every step reference in an input value, including inside lists and objects
+        if isinstance(value, dict):
+            for item in value.values():
+                yield from self.references(item)
+        elif isinstance(value, list):
+            for item in value:
+                yield from self.references(item)
+        elif isinstance(value, str):
+            match = STEP_REFERENCE.match(value.strip())
+            if match:
+                yield match.group(1), match.group(2)
+
+    def plan_graph(self, task_plan):
+        # Maps every step to the steps whose outputs it takes as inputs
+        steps = [str(i + 1) for i in range(int(task_plan["STEPS"]))]
+        graph = {}
+        for number in steps:
+            if number not in task_plan:
+                raise ValueError("Step " + number + " is missing from the plan")
+            dependencies = set()
+            for value in self.step_inputs(task_plan[number]).values():
+                for step, output in self.references(value):
+                    if step not in steps or step == number:
+                        raise ValueError("Step " + number + " uses output " + output + " of unknown step " + step)
+                    dependencies.add(step)
+            graph[number] = dependencies
+
+        # Kahn's algorithm, so a cycle fails before anything runs
+        remaining = {number: set(dependencies) for number, dependencies in graph.items()}
+        ready = [number for number, dependencies in remaining.items() if not dependencies]
+        while ready:
+            done = ready.pop()
+            for number, dependencies in remaining.items():
+                if done in dependencies:
+                    dependencies.discard(done)
+                    if not dependencies:
+                        ready.append(number)
+            del remaining[done]
+        if remaining:
+            raise ValueError("Steps " + ", ".join(sorted(remaining, key=int)) + " depend on each other")
+        return graph
+
+    def resolve_input(self, value, results):
+        # Step references are replaced by the output objects themselves, not their text
+        if isinstance(value, dict):
+            return {key: self.resolve_input(item, results) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve_input(item, results) for item in value]
+        if isinstance(value, str):
+            match = STEP_REFERENCE.match(value.strip())
+            if match:
+                return results[match.group(1)].get(match.group(2))
+        return value
+
+    def run_step(self, step, results):
+        inputs = {key: self.resolve_input(value, results) for key, value in self.step_inputs(step).items()}
+        task = self.tasks.get(step["TOOL_NAME"])
+        output = self.handle_task(step["TOOL_NAME"], inputs)
+        if task is None:
+            return {}
+        # Tools return a dictionary of outputs, a tuple in the order of their outputs, or their only output
+        names = [key for key, value in task.output_parameters]
+        if isinstance(output, dict):
+            return output
+        if isinstance(output, tuple):
+            return dict(zip(names, output))
+        return {names[0]: output} if names else {}
+
     def execute_tasks(self, task_plan):
-        for i in range(task_plan["STEPS"]):
-            print(task_plan[str(i+1)]["TOOL_NAME"])
-        return True
+        # Runs every step as soon as the steps it depends on are done, independent steps at the same time.
+        # Returns the outputs of every step by step number.
+        if task_plan.get("FAILURE") == "TRUE":
+            print(task_plan.get("REASON"))
+            return {}
+        self.plan_graph(task_plan)
+        return self.execute_stream(task_plan.items())
+
+    def execute_stream(self, members):
+        # Runs a plan while it is still being generated. members yields its (key, value) pairs as they complete,
+        # like plan_tasks(prompt, stream=True) does, and each step starts as soon as it and the steps it depends on
+        # are done. The plan is read on its own thread, so steps finishing and steps arriving are handled in turn.
+        events = queue.Queue()
+
+        def read():
+            try:
+                for key, value in members:
+                    events.put(("member", key, value))
+                events.put(("end", None, None))
+            except Exception as e:
+                events.put(("error", e, None))
+
+        threading.Thread(target=read, daemon=True).start()
+        task_plan = {}
+        graph = {}
+        results = {}
+        running = set()
+        ended = False
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while not ended or running:
+                kind, key, value = events.get()
+                if kind == "error":
+                    raise key
+                elif kind == "end":
+                    ended = True
+                elif kind == "done":
+                    running.discard(key)
+                    results[key] = value.result()
+                else:
+                    task_plan[key] = value
+                    if key.isdigit():
+                        graph[key] = {step for input_value in self.step_inputs(value).values() for step, _ in self.references(input_value)}
+                if task_plan.get("FAILURE") == "TRUE":
+                    continue
+                for number, dependencies in graph.items():
+                    if number not in results and number not in running and dependencies.issubset(results):
+                        running.add(number)
+                        future = pool.submit(self.run_step, task_plan[number], results)
+                        future.add_done_callback(lambda future, number=number: events.put(("done", number, future)))
+        if task_plan.get("FAILURE") == "TRUE":
+            print(task_plan.get("REASON"))
+        elif len(results) < len(graph):
+            waiting = sorted(set(graph) - set(results), key=int)
+            raise ValueError("Steps " + ", ".join(waiting) + " depend on steps that are missing or on each other")
+        return results
 
     def handle_task(self, task_name, inputs):
         task = self.tasks.get(task_name)
         if not task:
             return "Unknown task type"
-        return task["function"](inputs)
+        return task.function(inputs)
 
     def task_list(self):
-        list = "AVAILABLE TASKS:\n"
-        for name, task in self.tasks.items():
-            list += "`" + task.name + "`" + " - " + task.description + "\n"
-            list += "\t" + task.representation + "\n"
-            list += "".join(["\t\t" + key + " - " + value + "\n" for key, value in task.input_parameters])
-            list += "".join(["\t\t" + key + " - " + value + "\n" for key, value in task.output_parameters])
-        return list
+        if self.catalog is None:
+            lines = ["AVAILABLE TASKS:\n"]
+            for name, task in self.tasks.items():
+                lines.append("`" + task.name + "`" + " - " + task.description + "\n")
+                lines.append("\t" + task.representation + "\n")
+                lines.extend(["\t\t" + key + " - " + value + "\n" for key, value in task.input_parameters])
+                lines.extend(["\t\t" + key + " - " + value + "\n" for key, value in task.output_parameters])
+            self.catalog = "".join(lines)
+        return self.catalog
 
 # Step 4: Main Program
 def main():
@@ -103,7 +478,8 @@ def main():
         print("API key not found. Please check your .env file.")
         return
 
-    agent = Agent(config)
+    cache = CompletionCache(MemoryCache(), SQLiteCache(config.cache_path), bypass=config.cache_bypass)
+    agent = Agent(config, cache=cache)
     tasks = [Task("browser", "This tool returns the titles and URLs of the top 10 results for a search term.", [("X", "search term")], [("A", "success/fail"), ("B", "top 10 search results")], undef), Task("to_user", "This tool prints to the user.", [("X", "print data")], [("A", "success/fail")], undef)]
     handler = TaskHandler(agent, tasks)
 
@@ -116,6 +492,8 @@ def main():
         task_plan = handler.plan_tasks(prompt)
         print(json.dumps(task_plan, indent=4, separators=(",", ": "), sort_keys=True))
         handler.execute_tasks(task_plan)
+    print(cache.report())
+    cache.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,174 @@
+import collections
+import functools
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+WHITESPACE = re.compile(r"\s+")
+
+def message_text(content):
+    # Message content is either a string or a list of {"type": "text", "text": ...} parts
+    if isinstance(content, str):
+        return content
+    return "".join(part.get("text", "") for part in content)
+
+@functools.lru_cache(maxsize=256)
+def message_digest(role, text):
+    # Memoized, so the long system message that starts every request is normalized and hashed once
+    return hashlib.sha256((role + "\n" + WHITESPACE.sub(" ", text).strip()).encode("utf-8")).hexdigest()
+
+def cache_key(model, messages, parameters):
+    # Prompts that only differ in whitespace or in how their text is split into parts share a key
+    digests = [message_digest(message["role"], message_text(message["content"])) for message in messages]
+    data = json.dumps([model, digests, parameters], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+# Step 1: In-memory tier
+class MemoryCache:
+    # LRU of at most max_entries completions, each kept for ttl seconds
+    def __init__(self, max_entries=256, ttl=24 * 60 * 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# Step 2: On-disk tier
+class SQLiteCache:
+    # Completions stored in a SQLite file, shared by every run. Entries expire ttl seconds after they were stored,
+    # and the least recently used ones are deleted once the stored text goes over max_bytes.
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, ttl=7 * 24 * 60 * 60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                                "created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)")
+        self.connection.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl < now:
+                self.connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.connection.commit()
+                return None
+            self.connection.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)", (key, value, now, now, len(value.encode("utf-8"))))
+            self.evict(now)
+            self.connection.commit()
+
+    def evict(self, now):
+        self.connection.execute("DELETE FROM completions WHERE created < ?", (now - self.ttl,))
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.connection.execute("SELECT key, size FROM completions ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM completions")
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+# Step 3: Tiered cache
+class CompletionCache:
+    # Looks completions up in memory, then on disk, promoting disk hits to memory. Either tier can be left out.
+    # With bypass, nothing is read or stored, for runs that need fresh completions.
+    def __init__(self, memory=None, disk=None, bypass=False):
+        self.memory = memory
+        self.disk = disk
+        self.bypass = bypass
+        self.stats = {"memory hits": 0, "disk hits": 0, "misses": 0, "bypassed": 0}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, key):
+        if self.bypass:
+            self.count("bypassed")
+            return None
+        if self.memory is not None:
+            value = self.memory.get(key)
+            if value is not None:
+                self.count("memory hits")
+                return value
+        if self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                if self.memory is not None:
+                    self.memory.put(key, value)
+                self.count("disk hits")
+                return value
+        self.count("misses")
+        return None
+
+    def put(self, key, value):
+        if self.bypass:
+            return
+        if self.memory is not None:
+            self.memory.put(key, value)
+        if self.disk is not None:
+            self.disk.put(key, value)
+
+    def hit_rate(self):
+        hits = self.stats["memory hits"] + self.stats["disk hits"]
+        lookups = hits + self.stats["misses"]
+        return hits / lookups if lookups else 0.0
+
+    def report(self):
+        return ("Completion cache: " + str(self.stats["memory hits"]) + " memory hits, " + str(self.stats["disk hits"]) + " disk hits, "
+                + str(self.stats["misses"]) + " misses, " + str(self.stats["bypassed"]) + " bypassed, hit rate " + format(self.hit_rate(), ".0%"))
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
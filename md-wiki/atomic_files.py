@@ -0,0 +1,34 @@
+import os
+import json
+
+def write_file(file_path, content, encoding=None):
+    """
+    Writes a text or bytes file by renaming a temporary file over it. Readers never see a half-written file,
+    and a file that is hard-linked into another generation of the output is replaced instead of modified.
+    The content can also be an iterable of chunks, which are written one by one without being joined.
+    """
+    chunks = iter([content] if isinstance(content, (str, bytes)) else content)
+    first = next(chunks, '')
+    temporary_path = f'{file_path}.{os.getpid()}.tmp'
+    if isinstance(first, bytes):
+        f = open(temporary_path, 'wb')
+    else:
+        f = open(temporary_path, 'w', encoding=encoding)
+    with f:
+        f.write(first)
+        f.writelines(chunks)
+    os.replace(temporary_path, file_path)
+
+def read_json(file_path, description):
+    """
+    Returns the parsed content of a JSON file, or None if it doesn't exist or can't be read, in which case
+    the description of the file is printed along with the reason.
+    """
+    if not os.path.exists(file_path):
+        return None
+    try:
+        with open(file_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'Ignoring unreadable {description} {file_path}. Reason: {e}')
+        return None
@@ -0,0 +1,345 @@
+import os
+import argparse
+import datetime
+import difflib
+import html
+import itertools
+import json
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate_html import LinkIndex, SiteModel, TitleMatcher, analyze_markdown, anchor_edits, apply_edits, find_hyperlinks, header_anchor
+from markdown_renderers import DEFAULT_RENDERER, available_renderers, get_renderer
+from search_index import SearchIndex, SearchIndexWriter
+
+WORDS = ['dragon', 'board', 'game', 'video', 'about', 'me', 'dungeon', 'castle', 'river', 'map', 'spirit', 'island',
+         'dune', 'terra', 'mystica', 'notes', 'travel', 'recipe', 'music', 'garden', 'history', 'world', 'hex', 'player']
+# Words between the titles. None of them is in WORDS, so only the titles synthetic_page puts in a page match
+FILLER_WORDS = ['the', 'of', 'and', 'to', 'in', 'with', 'for', 'on', 'was', 'is', 'that', 'it', 'we', 'some', 'then', 'after',
+                'before', 'through', 'over', 'under', 'again', 'while', 'first', 'long', 'small', 'old', 'new', 'played', 'found', 'wrote']
+
+def synthetic_titles(count, rng):
+    """
+    Returns a set of unique page keys made of one to four words, like 'spirit island' or 'board game notes 12'.
+    """
+    titles = set()
+    while len(titles) < count:
+        words = rng.sample(WORDS, rng.randint(1, 3))
+        if rng.random() < 0.5:
+            words.append(str(rng.randint(0, count)))
+        titles.add(' '.join(words))
+    return titles
+
+def synthetic_page(titles, words, link_density, rng):
+    """
+    Returns a page of roughly the given number of words where about link_density of the words start a page title.
+    The other words come from FILLER_WORDS, which no title uses. titles is a sorted list, so the same seed always
+    picks the same titles.
+    """
+    parts = []
+    for _ in range(words):
+        if rng.random() < link_density:
+            parts.append(rng.choice(titles).title())
+        else:
+            parts.append(rng.choice(FILLER_WORDS))
+    return ' '.join(parts)
+
+def regex_links(titles, page):
+    """
+    The matcher used before TitleMatcher: one alternation of every title, longest first.
+    """
+    keys = sorted(titles, key=lambda key: (-len(key), key))
+    pattern = re.compile(r'\b(' + '|'.join(re.escape(key) for key in keys) + r')\b', re.IGNORECASE)
+    return [match.span() for match in pattern.finditer(page)]
+
+def trie_links(titles, page):
+    return list(TitleMatcher(titles).finditer(page))
+
+def time_call(function, *args, repeat=3):
+    """
+    Returns the result of the call and the best wall-clock time out of several runs.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result, best
+
+def bench_links(sizes, page_words, link_density, seed):
+    """
+    Compares the regex alternation and the trie matcher on the same synthetic titles and page.
+    """
+    print(f'{"titles":>8} {"regex (s)":>12} {"trie (s)":>12} {"speedup":>8} {"matches":>8}')
+    for size in sizes:
+        rng = random.Random(seed)
+        titles = synthetic_titles(size, rng)
+        page = synthetic_page(sorted(titles), page_words, link_density, rng)
+        regex_result, regex_time = time_call(regex_links, titles, page)
+        trie_result, trie_time = time_call(trie_links, titles, page)
+        if regex_result != trie_result:
+            raise AssertionError(f'Matchers disagree for {size} titles')
+        print(f'{size:>8} {regex_time:>12.4f} {trie_time:>12.4f} {regex_time / trie_time:>7.1f}x {len(trie_result):>8}')
+
+def synthetic_vocabulary(size, rng):
+    """
+    Returns size distinct made-up words.
+    """
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    vocabulary = set()
+    while len(vocabulary) < size:
+        vocabulary.add(''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))))
+    return sorted(vocabulary)
+
+def directory_size(directory, skip=()):
+    """
+    Returns the total size in bytes of the files directly in a directory, leaving out the named ones.
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file() and entry.name not in skip)
+
+def bench_search(pages, page_words, vocabulary_size, queries, seed):
+    """
+    Indexes a synthetic corpus whose word frequencies follow Zipf's law, then reports the index size
+    and the latency of random one to three word queries, both on a fresh index and once its shards are loaded.
+    """
+    rng = random.Random(seed)
+    vocabulary = synthetic_vocabulary(vocabulary_size, rng)
+    cumulative_weights = list(itertools.accumulate(1 / rank for rank in range(1, vocabulary_size + 1)))
+    texts = [' '.join(rng.choices(vocabulary, cum_weights=cumulative_weights, k=page_words)) for _ in range(pages)]
+    output_directory = tempfile.mkdtemp(prefix='md-wiki-search-')
+    state_directory = os.path.join(output_directory, 'state')
+    try:
+        writer = SearchIndexWriter(output_directory, state_directory)
+        start = time.perf_counter()
+        for page, text in enumerate(texts):
+            writer.add_page(f'page_{page}.html', f'Page {page}', text)
+        writer.finish()
+        build_time = time.perf_counter() - start
+        search_directory = os.path.join(output_directory, 'search')
+        served = directory_size(search_directory)
+        state = directory_size(state_directory)
+        shard_count = sum(1 for name in os.listdir(search_directory) if name.startswith('shard-'))
+        print(f'{pages} pages of {page_words} words, {vocabulary_size} word vocabulary')
+        print(f'index built in {build_time:.1f} s')
+        print(f'index size: {served / 1024 / 1024:.1f} MB in {shard_count} shards and pages.json, '
+              f'{served / pages:.0f} bytes per page, plus {state / 1024 / 1024:.1f} MB of build state')
+
+        query_list = [' '.join(rng.choices(vocabulary, cum_weights=cumulative_weights, k=rng.randint(1, 3))) for _ in range(queries)]
+        cold = []
+        for query in query_list:
+            start = time.perf_counter()
+            SearchIndex(output_directory).search(query)
+            cold.append(time.perf_counter() - start)
+        index = SearchIndex(output_directory)
+        for query in query_list:
+            index.search(query)
+        warm = []
+        for query in query_list:
+            start = time.perf_counter()
+            index.search(query)
+            warm.append(time.perf_counter() - start)
+        for name, latencies in (('cold', cold), ('warm', warm)):
+            latencies.sort()
+            print(f'{name} query latency: median {statistics.median(latencies) * 1000:.1f} ms, '
+                  f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms over {len(latencies)} queries')
+    finally:
+        shutil.rmtree(output_directory)
+
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Runs one build in a fresh interpreter, so its peak RSS is not inflated by earlier builds or by the benchmark itself
+BUILD_SCRIPT = """
+import json, resource, sys, time
+import generate_html
+start = time.perf_counter()
+generate_html.build(sys.argv[1], sys.argv[2], sys.argv[3], jobs=int(sys.argv[4]), search=sys.argv[5] == 'search', compress=sys.argv[6] == 'compress', cache_dir=sys.argv[7])
+seconds = time.perf_counter() - start
+print(json.dumps({'seconds': seconds, 'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  'worker_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}))
+"""
+
+def synthetic_wiki(directory, pages, page_words, link_density, rng):
+    """
+    Writes a notes tree of the given number of pages: sections of 100 pages with a home page and a description,
+    grouped 20 sections to a directory. Every page has a few headers and links to other pages at link_density.
+    """
+    titles = sorted(synthetic_titles(pages, rng))
+    for number, title in enumerate(titles):
+        section = number // 100
+        section_directory = os.path.join(directory, f'group_{section // 20:03d}', f'section_{section:03d}')
+        if number % 100 == 0:
+            os.makedirs(section_directory)
+            with open(os.path.join(section_directory, 'home.md'), 'w') as f:
+                f.write(f'# Section {section}\n\n{synthetic_page(titles, page_words // 4, link_density, rng)}\n')
+            with open(os.path.join(section_directory, 'description.txt'), 'w') as f:
+                f.write(f'Synthetic section {section}\n')
+        paragraphs = [f'## {rng.choice(FILLER_WORDS).title()} {part}\n\n{synthetic_page(titles, page_words // 4, link_density, rng)}' for part in range(4)]
+        with open(os.path.join(section_directory, title.replace(' ', '_') + '.md'), 'w') as f:
+            f.write(f'# {title.title()}\n\n' + '\n\n'.join(paragraphs) + '\n')
+    with open(os.path.join(directory, 'home.md'), 'w') as f:
+        f.write('# Synthetic wiki\n')
+
+def git_revision():
+    try:
+        return subprocess.run(['git', '-C', MODULE_DIRECTORY, 'rev-parse', '--short', 'HEAD'], check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_build(sizes, link_densities, page_words, jobs, search, compress, seed, record):
+    """
+    Builds synthetic wikis of every size and link density from scratch and reports the build time and peak RSS.
+    The same seed always generates the same wikis. With record, every result is also appended as a JSON line
+    to that file, along with the date and git revision, to follow them across changes.
+    """
+    print(f'{"pages":>8} {"density":>8} {"build (s)":>10} {"pages/s":>8} {"RSS (MB)":>9} {"worker RSS (MB)":>16}')
+    for size in sizes:
+        for link_density in link_densities:
+            working_directory = tempfile.mkdtemp(prefix='md-wiki-build-')
+            try:
+                root_directory = os.path.join(working_directory, 'notes')
+                synthetic_wiki(root_directory, size, page_words, link_density, random.Random(seed))
+                process = subprocess.run([sys.executable, '-c', BUILD_SCRIPT, root_directory, os.path.join(MODULE_DIRECTORY, 'html-source'),
+                                          os.path.join(working_directory, 'output'), str(jobs), 'search' if search else '',
+                                          'compress' if compress else '', os.path.join(working_directory, 'cache')],
+                                         cwd=MODULE_DIRECTORY, check=True, capture_output=True, text=True)
+                result = json.loads(process.stdout.splitlines()[-1])
+            finally:
+                shutil.rmtree(working_directory)
+            worker_rss = f'{result["worker_rss_kb"] / 1024:>16.1f}' if jobs > 1 else f'{"-":>16}'
+            print(f'{size:>8} {link_density:>8.3f} {result["seconds"]:>10.1f} {size / result["seconds"]:>8.0f} '
+                  f'{result["rss_kb"] / 1024:>9.1f} {worker_rss}')
+            if record:
+                with open(record, 'a') as f:
+                    f.write(json.dumps({'date': datetime.datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+                                        'pages': size, 'link_density': link_density, 'page_words': page_words, 'jobs': jobs,
+                                        'search': search, 'compress': compress, 'seed': seed, **result}) + '\n')
+
+TAG_GAP = re.compile(r'>\s+<')
+WHITESPACE = re.compile(r'\s+')
+HREF = re.compile(r'href="([^"]*)"')
+
+def normalize_html(html_content):
+    """
+    Collapses whitespace, which backends lay out differently without it changing how a page looks.
+    """
+    return WHITESPACE.sub(' ', TAG_GAP.sub('><', html_content)).strip()
+
+def prepared_pages(root_directory):
+    """
+    Returns the (path, Markdown, anchors, hrefs) of every published page, with the Markdown as it reaches the renderer:
+    hyperlinks added, and header anchors on content pages. anchors and hrefs are what the output has to keep.
+    """
+    link_index = LinkIndex(root_directory)
+    pages = []
+    for directory in SiteModel(root_directory).directories.values():
+        for file, _, _ in directory.pages:
+            with open(os.path.join(directory.path, file), 'r') as f:
+                md_content = f.read()
+            analysis = analyze_markdown(md_content)
+            edits = find_hyperlinks(md_content, analysis, file, directory.path, link_index)
+            hrefs = sorted({HREF.search(replacement).group(1) for _, _, replacement in edits})
+            anchors = []
+            if file != 'home.md':
+                edits += anchor_edits(analysis)
+                anchors = sorted({header_anchor(title) for _, title, _, _ in analysis.headers})
+            pages.append((os.path.relpath(os.path.join(directory.path, file), root_directory), apply_edits(md_content, edits), anchors, hrefs))
+    return pages
+
+def bench_markdown(root_directory, backends, repeat, diffs):
+    """
+    Renders every page of a wiki with each Markdown backend and reports how fast it is next to markdown2, on how many
+    pages its output differs from markdown2's once whitespace is collapsed, and on how many pages a header anchor
+    or a hyperlink went missing. With diffs, prints the differences of up to that many pages per backend.
+    """
+    pages = prepared_pages(root_directory)
+    reference = get_renderer(DEFAULT_RENDERER)
+    expected = [normalize_html(reference.render(md_content)) for _, md_content, _, _ in pages]
+    print(f'{len(pages)} pages, {sum(len(md_content) for _, md_content, _, _ in pages) / 1024:.0f} KB of Markdown')
+    print(f'{"backend":>12} {"version":>12} {"render (s)":>11} {"pages/s":>8} {"speedup":>8} {"differ":>7} {"lost anchors":>13} {"lost links":>11}')
+    render_all = lambda renderer: [renderer.render(md_content) for _, md_content, _, _ in pages]
+    reference_time = time_call(render_all, reference, repeat=repeat)[1]
+    for name in backends:
+        renderer = get_renderer(name)
+        outputs, seconds = time_call(render_all, renderer, repeat=repeat)
+        differing = []
+        lost_anchors = lost_links = 0
+        for (path, _, anchors, hrefs), output, reference_output in zip(pages, outputs, expected):
+            # Backends differ in whether they escape & in attributes
+            unescaped = html.unescape(output)
+            if any(f'id="{anchor}"' not in unescaped for anchor in anchors):
+                lost_anchors += 1
+            if any(f'href="{href}"' not in unescaped for href in hrefs):
+                lost_links += 1
+            if normalize_html(output) != reference_output:
+                differing.append((path, output, reference_output))
+        print(f'{name:>12} {renderer.version:>12} {seconds:>11.3f} {len(pages) / seconds:>8.0f} {reference_time / seconds:>7.1f}x '
+              f'{len(differing):>7} {lost_anchors:>13} {lost_links:>11}')
+        for path, output, reference_output in differing[:diffs]:
+            print(f'--- {path}')
+            # Break the collapsed HTML at tags so the diff points at the element that differs
+            lines = difflib.unified_diff(reference_output.replace('><', '>\n<').splitlines(), normalize_html(output).replace('><', '>\n<').splitlines(),
+                                         DEFAULT_RENDERER, name, lineterm='', n=1)
+            print('\n'.join(list(lines)[2:]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks for the wiki generator.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    links_parser = subparsers.add_parser('links', help='compare the regex and trie wiki-link matchers')
+    links_parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='numbers of page titles')
+    links_parser.add_argument('--page-words', type=int, default=20000, help='number of words on the matched page')
+    links_parser.add_argument('--link-density', type=float, default=0.02, help='fraction of words that start a title')
+    links_parser.add_argument('--seed', type=int, default=0)
+    search_parser = subparsers.add_parser('search', help='measure the size and query latency of the search index')
+    search_parser.add_argument('--pages', type=int, default=50000, help='number of pages in the corpus')
+    search_parser.add_argument('--page-words', type=int, default=100, help='number of words on every page')
+    search_parser.add_argument('--vocabulary', type=int, default=20000, help='number of distinct words')
+    search_parser.add_argument('--queries', type=int, default=200, help='number of queries to time')
+    search_parser.add_argument('--seed', type=int, default=0)
+    build_parser = subparsers.add_parser('build', help='measure build time and peak RSS on synthetic wikis')
+    build_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='numbers of pages')
+    build_parser.add_argument('--link-densities', type=float, nargs='+', default=[0.005, 0.02], help='fractions of words that start a title')
+    build_parser.add_argument('--page-words', type=int, default=400, help='number of words on every page')
+    build_parser.add_argument('--jobs', type=int, default=1, help='number of processes used to render pages')
+    build_parser.add_argument('--no-search', action='store_true', help='do not generate the full-text search index')
+    build_parser.add_argument('--no-compress', action='store_true', help='do not write precompressed siblings')
+    build_parser.add_argument('--record', help='JSON lines file the results are appended to')
+    build_parser.add_argument('--seed', type=int, default=0)
+    markdown_parser = subparsers.add_parser('markdown', help='compare the output and speed of the Markdown backends')
+    markdown_parser.add_argument('--root', default=os.path.join(MODULE_DIRECTORY, 'md-source'), help='wiki whose pages are rendered')
+    markdown_parser.add_argument('--synthetic', type=int, metavar='PAGES', help='render a synthetic wiki of that many pages instead')
+    markdown_parser.add_argument('--backends', nargs='+', default=available_renderers(), help='backends to compare (default: all installed)')
+    markdown_parser.add_argument('--page-words', type=int, default=400, help='number of words on every synthetic page')
+    markdown_parser.add_argument('--repeat', type=int, default=3, help='renders of the corpus per backend, the fastest counts')
+    markdown_parser.add_argument('--diffs', type=int, default=0, help='print the differences of up to this many pages per backend')
+    markdown_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark == 'links':
+        bench_links(args.sizes, args.page_words, args.link_density, args.seed)
+    elif args.benchmark == 'search':
+        bench_search(args.pages, args.page_words, args.vocabulary, args.queries, args.seed)
+    elif args.benchmark == 'build':
+        bench_build(args.sizes, args.link_densities, args.page_words, args.jobs, not args.no_search, not args.no_compress, args.seed, args.record)
+    elif args.benchmark == 'markdown':
+        try:
+            for backend in args.backends:
+                get_renderer(backend)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.synthetic:
+            working_directory = tempfile.mkdtemp(prefix='md-wiki-markdown-')
+            try:
+                root_directory = os.path.join(working_directory, 'notes')
+                synthetic_wiki(root_directory, args.synthetic, args.page_words, 0.02, random.Random(args.seed))
+                bench_markdown(root_directory, args.backends, args.repeat, args.diffs)
+            finally:
+                shutil.rmtree(working_directory)
+        else:
+            bench_markdown(args.root, args.backends, args.repeat, args.diffs)
@@ -1,46 +1,542 @@
 import os
-import markdown2
+import bisect
+import posixpath
 import re
 import shutil
 import pwd
 import time
+import json
+import hashlib
+import argparse
+import collections
+import subprocess
+import functools
+import threading
+import http.server
+import urllib.parse
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from xml.sax.saxutils import escape as xml_escape
+from atomic_files import write_file
+from search_index import SearchIndexWriter
+from link_graph import LinkGraph
+from markdown_renderers import RENDERERS, DEFAULT_RENDERER, available_renderers, get_renderer
 
-def convert_md_to_html(md_content):
+try:
+    import brotli
+except ImportError:
+    brotli = None  # Only .gz siblings are written
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None  # Watch mode falls back to polling
+
+MANIFEST_NAME = '.build-manifest.json'
+LEGACY_GIT_METADATA_NAME = '.git-metadata.json'  # Where older builds cached git metadata, in the output
+CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'md-wiki')
+MANIFEST_VERSION = 4  # Bump whenever the generated HTML changes for identical inputs
+
+COMPRESSED_SUFFIXES = ('.gz', '.br')
+
+def compressed_chunks(chunks, compress, finish):
     """
-    Converts Markdown content to HTML using the markdown2 library.
+    Yields the output of a streaming compressor fed the chunks one at a time, encoding text chunks as UTF-8.
     """
-    return markdown2.markdown(md_content)
+    for chunk in chunks:
+        yield compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+    yield finish()
 
-def create_hyperlinks(md_content, files, current_file, current_directory, root_directory):
+def compress_file(file_path, content):
     """
-    Converts plain text references to other Markdown files into hyperlinks in the given Markdown content.
+    Writes the precompressed siblings of an output file, file.gz and, when brotli is installed, file.br,
+    for web servers that serve them directly (nginx gzip_static/brotli_static). The content is a string, bytes
+    or a list of chunks, and is compressed and written chunk by chunk.
     """
-    links = {}
-    for dirpath, _, filenames in os.walk(root_directory):
-        for filename in filenames:
-            if filename.endswith('.md'):
-                # Create a dictionary of {file_name_without_extension: relative_path_to_html_file}
-                file_key = filename.replace('_', ' ').replace('.md', '').lower()
-                relative_path = os.path.relpath(os.path.join(dirpath, filename), current_directory).replace(os.sep, '/')
-                links[file_key] = relative_path.replace('.md', '.html')
+    chunks = [content] if isinstance(content, (str, bytes)) else content
+    # A gzip stream with a zero mtime, so the .gz bytes are identical across builds of the same file
+    gzip_stream = zlib.compressobj(9, zlib.DEFLATED, 31)
+    write_file(file_path + '.gz', compressed_chunks(chunks, gzip_stream.compress, gzip_stream.flush))
+    if brotli is not None:
+        brotli_stream = brotli.Compressor()
+        write_file(file_path + '.br', compressed_chunks(chunks, brotli_stream.process, brotli_stream.finish))
+
+def remove_compressed(file_path):
+    """
+    Deletes the precompressed siblings of an output file, if it has any.
+    """
+    for suffix in COMPRESSED_SUFFIXES:
+        try:
+            os.unlink(file_path + suffix)
+        except FileNotFoundError:
+            pass
+
+def remove_output(file_path):
+    """
+    Deletes an output file and its precompressed siblings. Returns whether the file itself existed.
+    """
+    remove_compressed(file_path)
+    try:
+        os.unlink(file_path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def has_compressed(file_path):
+    """
+    Returns whether an output file has every precompressed sibling this build would write for it.
+    """
+    return os.path.exists(file_path + '.gz') and (brotli is None or os.path.exists(file_path + '.br'))
+
+class Compressor:
+    """
+    Compresses output files on a thread pool while the build goes on. zlib and brotli release the GIL,
+    so the files are compressed in parallel. Files handed to submit() are compressed, i.e. the ones this build
+    wrote, along with the unchanged ones handed to submit_missing() that lack a sibling, e.g. because an earlier
+    build ran without compression. At most a few per thread wait in memory.
+    """
+    def __init__(self, threads=None):
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = collections.deque()
+        self.submitted = set()
+        self.count = 0
+
+    def submit(self, file_path, content):
+        self.submitted.add(file_path)
+        self.pending.append(self.pool.submit(compress_file, file_path, content))
+        self.count += 1
+        while self.pending and (self.pending[0].done() or len(self.pending) > self.threads * 4):
+            self.pending.popleft().result()
+
+    def submit_file(self, file_path):
+        with open(file_path, 'rb') as f:
+            self.submit(file_path, f.read())
+
+    def submit_missing(self, file_path):
+        """
+        Compresses an output file this build left unchanged, if it exists and is missing a sibling.
+        """
+        if file_path not in self.submitted and os.path.exists(file_path) and not has_compressed(file_path):
+            self.submit_file(file_path)
+
+    def close(self):
+        """
+        Waits for every file to be compressed and shuts the pool down.
+        """
+        while self.pending:
+            self.pending.popleft().result()
+        self.pool.shutdown()
+
+def compress_outputs(compressor, file_paths):
+    """
+    Hands files that were just rewritten to the compressor. Without one, their siblings from an earlier compressed
+    build are deleted, since a web server would serve them instead of the new files.
+    """
+    for file_path in file_paths:
+        if compressor is not None:
+            compressor.submit_file(file_path)
+        else:
+            remove_compressed(file_path)
+
+class Prefetcher:
+    """
+    Runs blocking filesystem calls on a thread pool ahead of the build, for notes on a network filesystem where every
+    open, stat and listdir is a round-trip. The build still takes the results in the order it would have made the
+    calls itself, so the output is exactly the same as without prefetching, only the waits overlap.
+    At most threads calls are in flight.
+    """
+    def __init__(self, threads=8):
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def submit(self, function, *args):
+        return self.pool.submit(function, *args)
+
+    def map(self, function, items):
+        """
+        Like the built-in map, but calls the function on items up to a few per thread ahead of the one being consumed.
+        """
+        pending = collections.deque()
+        for item in items:
+            pending.append(self.pool.submit(function, item))
+            if len(pending) > self.threads * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        self.pool.shutdown()
+
+def prefetch_map(io, function, items):
+    """
+    Maps the function over the items on the Prefetcher, or inline without one.
+    """
+    return map(function, items) if io is None else io.map(function, items)
+
+def convert_md_to_html(md_content, renderer=None):
+    """
+    Converts Markdown content to HTML with a MarkdownRenderer, markdown2 by default.
+    """
+    if renderer is None:
+        renderer = get_renderer()
+    return renderer.render(md_content)
+
+class RenderCache:
+    """
+    On-disk cache of rendered Markdown shared by every build on this machine. Entries are keyed by a hash of the
+    processed Markdown and the key of the renderer, i.e. its backend, version and options, so they never go stale, only cold.
+    Each entry is one file whose mtime is bumped on every hit; evict() deletes the least recently used entries
+    until the cache fits in max_bytes.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
 
-    # Remove current file from links to avoid self-referencing
-    current_file_key = os.path.splitext(current_file)[0].replace('_', ' ').lower()
-    if current_file_key in links:
-        del links[current_file_key]
+    def _path(self, md_content, renderer):
+        key = hashlib.sha256(f'{renderer.key}\n{md_content}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key[2:] + '.html')
 
-    def replace_link(match):
+    def get(self, md_content, renderer):
         """
-        Replace plain text references with HTML hyperlinks.
+        Returns the HTML the renderer made of the Markdown, or None.
         """
-        text = match.group(0)
-        text_key = text.strip().lower()
-        if text_key in links:
-            return f'<a href="{links[text_key]}">{text}</a>'
-        return text
+        path = self._path(md_content, renderer)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                html_content = f.read()
+            os.utime(path)
+            return html_content
+        except OSError:
+            return None
 
-    pattern = re.compile(r'\b(' + '|'.join(re.escape(key) for key in links.keys()) + r')\b', re.IGNORECASE)
-    return pattern.sub(replace_link, md_content)
+    def put(self, md_content, renderer, html_content):
+        """
+        Stores the HTML the renderer made of the Markdown. Entries are written to a temporary file and renamed into place,
+        so concurrent builds and render workers never read half an entry.
+        """
+        path = self._path(md_content, renderer)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_file(path, html_content, encoding='utf-8')
+        except OSError as e:
+            print(f'Failed to write render cache entry {path}. Reason: {e}')
+
+    def evict(self):
+        """
+        Deletes the least recently used entries until the cache fits in max_bytes. Returns how many were deleted.
+        """
+        entries = []
+        total = 0
+        if not os.path.isdir(self.directory):
+            return 0
+        for shard in os.scandir(self.directory):
+            if len(shard.name) != 2 or not shard.is_dir():
+                continue  # Build state other than render entries lives next to the shards
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith('.tmp'):
+                    continue  # Another build's entry being written
+                try:
+                    entry_stat = entry.stat()
+                except OSError:
+                    continue  # Replaced or evicted by another build since the scan
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+                total += entry_stat.st_size
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+def render_markdown(md_content, cache, timings, renderer=None):
+    """
+    Converts Markdown to HTML with the renderer, going through the render cache when there is one.
+    Time spent on cache hits is recorded under the 'cache' stage, conversions under 'markdown'.
+    """
+    if renderer is None:
+        renderer = get_renderer()
+    if cache is None:
+        return timed(timings, 'markdown', convert_md_to_html, md_content, renderer)
+    start = time.perf_counter()
+    html_content = cache.get(md_content, renderer)
+    if html_content is not None:
+        timings['cache'] = timings.get('cache', 0.0) + time.perf_counter() - start
+        return html_content
+    html_content = convert_md_to_html(md_content, renderer)
+    cache.put(md_content, renderer, html_content)
+    timings['markdown'] = timings.get('markdown', 0.0) + time.perf_counter() - start
+    return html_content
+
+def page_key(file_name):
+    """
+    Returns the key other pages use to refer to a Markdown file, e.g. 'about_me.md' -> 'about me'.
+    """
+    return os.path.splitext(file_name)[0].replace('_', ' ').lower()
+
+class TitleMatcher:
+    """
+    Character trie over lowercased page keys that finds references to pages in a single left-to-right scan.
+    Matches are case-insensitive, whole-word and, at any position, the longest key wins. This behaves like
+    the regex alternation \\b(key|...)\\b with longest keys first, without trying every key at every position.
+    """
+    TERMINAL = ''  # Never a single character, so it can't collide with a trie edge
+
+    def __init__(self, keys):
+        self.root = {}
+        for key in keys:
+            if not key:
+                continue
+            node = self.root
+            for char in key:
+                node = node.setdefault(char, {})
+            node[self.TERMINAL] = True
+
+    @staticmethod
+    def _is_word(char):
+        return char.isalnum() or char == '_'
+
+    def finditer(self, text):
+        """
+        Yields the (start, end) span of every match in the text.
+        """
+        if not self.root:
+            return
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # A few characters lowercase to several, keep offsets aligned with the original text
+            lowered = ''.join(char.lower() if len(char.lower()) == 1 else char for char in text)
+        root = self.root
+        is_word = self._is_word
+        length = len(text)
+        position = 0
+        previous_is_word = False
+        while position < length:
+            node = root.get(lowered[position])
+            current_is_word = is_word(text[position])
+            if node is None or previous_is_word == current_is_word:
+                # No key starts with this character, or there is no word boundary here
+                previous_is_word = current_is_word
+                position += 1
+                continue
+            end = -1
+            index = position + 1
+            while node is not None:
+                if self.TERMINAL in node and is_word(text[index - 1]) != (index < length and is_word(text[index])):
+                    end = index
+                if index == length:
+                    break
+                node = node.get(lowered[index])
+                index += 1
+            if end == -1:
+                previous_is_word = current_is_word
+                position += 1
+                continue
+            yield position, end
+            previous_is_word = is_word(text[end - 1])
+            position = end
+
+    def sub(self, replace, text):
+        """
+        Returns the text with every match replaced by replace(matched_text).
+        """
+        parts = []
+        last = 0
+        for start, end in self.finditer(text):
+            parts.append(text[last:start])
+            parts.append(replace(text[start:end]))
+            last = end
+        if not parts:
+            return text
+        parts.append(text[last:])
+        return ''.join(parts)
+
+class LinkIndex:
+    """
+    Index of every page in the wiki, built once per run and shared by all pages.
+    Maps page keys to output paths relative to the root directory and holds a single matcher for all of them.
+    """
+    def __init__(self, root_directory, io=None):
+        self.root_directory = root_directory
+        self.targets = collect_link_targets(root_directory, io)
+        self.links = {}
+        for target in self.targets:
+            # Later targets win, so a key shared by several pages resolves to the last one walked
+            self.links[page_key(os.path.basename(target))] = os.path.splitext(target)[0] + '.html'
+        self.matcher = TitleMatcher(self.links)
+        self._relative_directories = {}
+
+    def href(self, key, current_directory):
+        """
+        Returns the link to the page with the given key, relative to the given directory.
+        """
+        relative_directory = self._relative_directories.get(current_directory)
+        if relative_directory is None:
+            relative_directory = os.path.relpath(current_directory, self.root_directory).replace(os.sep, '/')
+            self._relative_directories[current_directory] = relative_directory
+        return posixpath.relpath(self.links[key], relative_directory)
+
+HEADER_LINE = re.compile(r'(#{1,6})[ \t]+(.*)')
+FENCE_LINE = re.compile(r' {0,3}(`{3,})')  # markdown2's fenced-code-blocks extra only knows backtick fences
+BACKTICKS = re.compile(r'`+')
+CLOSING_FENCE = re.compile(r'^ {0,3}(`{3,})[^\S\n]*$', re.MULTILINE)
+BLANK_LINE = re.compile(r'\n[^\S\n]*\n')
+
+class MarkdownAnalysis:
+    """
+    Result of a single tokenizing pass over a page's Markdown.
+    headers holds a (hashes, title, hashes_end, title_start) tuple for every header outside fenced code blocks.
+    text_spans holds the (start, end) ranges outside fenced code blocks and inline code, where page references are looked for.
+    """
+    def __init__(self, headers, text_spans):
+        self.headers = headers
+        self.text_spans = text_spans
+
+def _split_inline_code(md_content, start, end, text_spans):
+    """
+    Adds the parts of md_content[start:end] that are not inside `inline code` to text_spans.
+    A run of backticks is only code when a run of the same length in the same paragraph closes it, otherwise
+    it is plain text. Like markdown2, code spans never reach across a blank line.
+    """
+    for match in BLANK_LINE.finditer(md_content, start, end):
+        _split_paragraph_code(md_content, start, match.start(), text_spans)
+        start = match.start()
+    _split_paragraph_code(md_content, start, end, text_spans)
+
+def _split_paragraph_code(md_content, start, end, text_spans):
+    runs = [match.span() for match in BACKTICKS.finditer(md_content, start, end)]
+    cursor = start
+    i = 0
+    while i < len(runs):
+        run_start, run_end = runs[i]
+        closing = next((j for j in range(i + 1, len(runs)) if runs[j][1] - runs[j][0] == run_end - run_start), None)
+        if closing is None:
+            i += 1
+            continue
+        if run_start > cursor:
+            text_spans.append((cursor, run_start))
+        cursor = runs[closing][1]
+        i = closing + 1
+    if end > cursor:
+        text_spans.append((cursor, end))
+
+def _closing_fences(md_content):
+    """
+    Returns the starts of the lines that can close a fence, and for each the most backticks any of them from there on has.
+    """
+    starts = []
+    backticks = []
+    if '```' in md_content:
+        for match in CLOSING_FENCE.finditer(md_content):
+            starts.append(match.start())
+            backticks.append(len(match.group(1)))
+        for i in range(len(backticks) - 2, -1, -1):
+            backticks[i] = max(backticks[i], backticks[i + 1])
+    return starts, backticks
+
+def _is_closed(closings, start, backticks):
+    """
+    Returns whether a line at or after start closes a fence of that many backticks.
+    """
+    starts, most_backticks = closings
+    i = bisect.bisect_left(starts, start)
+    return i < len(starts) and most_backticks[i] >= backticks
+
+def analyze_markdown(md_content):
+    """
+    Scans the Markdown once, line by line, for headers, fenced code blocks and inline code.
+    A fence only opens a code block when a closing fence follows it. Otherwise markdown2 renders it as text,
+    and so does this, with the headers and references after it.
+    """
+    headers = []
+    text_spans = []
+    closings = _closing_fences(md_content)
+    fence = None
+    prose_start = 0
+    position = 0
+    length = len(md_content)
+    while position < length:
+        line_end = md_content.find('\n', position)
+        if line_end == -1:
+            line_end = length
+        line = md_content[position:line_end]
+        next_position = line_end + 1
+        if fence is not None:
+            # A fence is closed by at least as many backticks and nothing else on the line
+            match = FENCE_LINE.match(line)
+            if match and len(match.group(1)) >= len(fence) and not line[match.end():].strip():
+                fence = None
+                prose_start = next_position
+        else:
+            match = FENCE_LINE.match(line)
+            if match and _is_closed(closings, next_position, len(match.group(1))):
+                fence = match.group(1)
+                _split_inline_code(md_content, prose_start, position, text_spans)
+            else:
+                match = HEADER_LINE.match(line)
+                if match:
+                    headers.append((match.group(1), match.group(2), position + match.end(1), position + match.start(2)))
+        position = next_position
+    if fence is None:
+        _split_inline_code(md_content, prose_start, length, text_spans)
+    return MarkdownAnalysis(headers, text_spans)
+
+def apply_edits(md_content, edits):
+    """
+    Applies (start, end, replacement) edits to the Markdown in one join. Edits must not overlap,
+    and an insertion (start == end) goes before a replacement starting at the same position.
+    """
+    if not edits:
+        return md_content
+    parts = []
+    last = 0
+    for start, end, replacement in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+        parts.append(md_content[last:start])
+        parts.append(replacement)
+        last = end
+    parts.append(md_content[last:])
+    return ''.join(parts)
+
+def find_hyperlinks(md_content, analysis, current_file, current_directory, link_index):
+    """
+    Returns the edits that turn plain text references to other Markdown files into hyperlinks.
+    """
+    edits = []
+    for start, end, text_key in _page_references(md_content, analysis, current_file, link_index):
+        edits.append((start, end, f'<a href="{link_index.href(text_key, current_directory)}">{md_content[start:end]}</a>'))
+    return edits
+
+def _page_references(md_content, analysis, current_file, link_index):
+    """
+    Yields the (start, end, key) of every reference to another page in the Markdown.
+    """
+    # Skip the current file to avoid self-referencing
+    current_file_key = page_key(current_file)
+    for span_start, span_end in analysis.text_spans:
+        text = md_content[span_start:span_end]
+        for start, end in link_index.matcher.finditer(text):
+            text_key = text[start:end].strip().lower()
+            if text_key in link_index.links and text_key != current_file_key:
+                yield span_start + start, span_start + end, text_key
+
+def linked_pages(md_content, analysis, current_file, link_index):
+    """
+    Returns the set of pages, as output paths relative to the root, that create_hyperlinks would link to.
+    """
+    return {link_index.links[key] for _, _, key in _page_references(md_content, analysis, current_file, link_index)}
+
+def create_hyperlinks(md_content, current_file, current_directory, link_index, analysis=None):
+    """
+    Converts plain text references to other Markdown files into hyperlinks in the given Markdown content.
+    """
+    if analysis is None:
+        analysis = analyze_markdown(md_content)
+    return apply_edits(md_content, find_hyperlinks(md_content, analysis, current_file, current_directory, link_index))
 
 def generate_breadcrumbs(directory, current_file, root_directory):
     """
@@ -67,20 +563,26 @@ def generate_breadcrumbs(directory, current_file, root_directory):
 
     return breadcrumb_html
 
-def generate_toc(md_content):
+def header_anchor(title):
+    """
+    Returns the anchor name used for a header, e.g. 'My Header' -> 'my-header'.
+    """
+    return re.sub(r'\s+', '-', title.lower())
+
+def generate_toc(md_content, analysis=None):
     """
     Generates a Table of Contents (TOC) with numbered entries for each header in the Markdown content.
     """
-    headers = re.findall(r'^(#{1,6})\s+(.*)', md_content, re.MULTILINE)
+    if analysis is None:
+        analysis = analyze_markdown(md_content)
     toc = []
     header_counters = [0] * 6  # Support up to 6 levels of headers
 
-    for header in headers:
-        level = len(header[0]) - 1  # 0-based index
+    for hashes, title, _, _ in analysis.headers:
+        level = len(hashes) - 1  # 0-based index
         if level == 0:
             level = 1  # Treating # and ## headers the same
-        title = header[1]
-        anchor = re.sub(r'\s+', '-', title.lower())
+        anchor = header_anchor(title)
         
         # Increment the current level counter
         header_counters[level] += 1
@@ -97,82 +599,396 @@ def generate_toc(md_content):
 
     return '\n'.join(toc)
 
-def add_anchors(md_content):
+def anchor_edits(analysis):
+    """
+    Returns the edits that put an HTML anchor tag in front of every header's text.
+    """
+    edits = []
+    for _, title, hashes_end, title_start in analysis.headers:
+        anchor_name = header_anchor(title)
+        edits.append((hashes_end, title_start, f' <a name="{anchor_name}" id="{anchor_name}"></a>'))
+    return edits
+
+def add_anchors(md_content, analysis=None):
     """
     Adds HTML anchor tags to headers in the Markdown content for linking.
     """
-    def anchor_replacer(match):
-        header_level = match.group(1)
-        header_text = match.group(2)
-        anchor_name = re.sub(r'\s+', '-', header_text.lower())
-        return f'{header_level} <a name="{anchor_name}" id="{anchor_name}"></a>{header_text}'
-    
-    md_content = re.sub(r'^(#{1,6})\s+(.*)', anchor_replacer, md_content, flags=re.MULTILINE)
-    return md_content
+    if analysis is None:
+        analysis = analyze_markdown(md_content)
+    return apply_edits(md_content, anchor_edits(analysis))
 
-def generate_html_from_template(template_path, page_title, css_path, breadcrumbs, content, sub_pages, toc, last_mod_time, username):
+class Template:
     """
-    Generates HTML content by filling in a template with the given parameters.
+    HTML template compiled once per build. The source is split into literal text and {{PLACEHOLDER}} names,
+    so every page is rendered with a single join however many placeholders the template uses.
     """
-    with open(template_path, 'r') as template_file:
-        template = template_file.read()
+    PLACEHOLDER = re.compile(r'\{\{([A-Z0-9_]+)\}\}')
 
-    html_content = template.replace('{{PAGE_TITLE}}', page_title)
-    html_content = html_content.replace('{{CSS_PATH}}', css_path)
-    html_content = html_content.replace('{{BREADCRUMBS}}', breadcrumbs)
-    html_content = html_content.replace('{{CONTENT}}', content)
-    html_content = html_content.replace('{{SUB_PAGES}}', sub_pages)
-    html_content = html_content.replace('{{TOC}}', toc)
-    html_content = html_content.replace('{{LAST_MOD_TIME}}', last_mod_time)
-    html_content = html_content.replace('{{USERNAME}}', username)
+    def __init__(self, source, stylesheet='styles.css'):
+        self.source = source
+        self.stylesheet = stylesheet  # Name of the stylesheet in the output root, which {{CSS_PATH}} points to
+        # re.split with a group alternates literal text (even indices) and placeholder names (odd indices)
+        self.segments = self.PLACEHOLDER.split(source)
+        self.placeholders = set(self.segments[1::2])
 
-    return html_content
+    @classmethod
+    def load(cls, template_path):
+        with open(template_path, 'r') as template_file:
+            return cls(template_file.read())
 
-def generate_home_page(directory, files, subdirectories, home_content, output_dir, root_directory, ignore_list, template_path):
+    def render_chunks(self, values):
+        """
+        Fills in the placeholders from the values dictionary and returns the pieces of the page in order,
+        without joining them. Placeholders without a value are left as they are.
+        """
+        parts = self.segments[:]
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = values[name] if name in values else '{{' + name + '}}'
+        return parts
+
+    def render(self, values):
+        """
+        Fills in the placeholders from the values dictionary. Placeholders without a value are left as they are.
+        """
+        return ''.join(self.render_chunks(values))
+
+def generate_html_from_template(template, page_title, css_path, breadcrumbs, content, sub_pages, toc, last_mod_time, username, chunked=False, **extra):
+    """
+    Generates HTML content by filling in a compiled template with the given parameters.
+    Extra keyword arguments fill in additional placeholders of the same name, e.g. FOOTER='...' for {{FOOTER}}.
+    With chunked, the page is returned as a list of pieces for write_file, which saves joining them into one string.
+    """
+    values = {
+        'PAGE_TITLE': page_title,
+        'CSS_PATH': css_path,
+        'BREADCRUMBS': breadcrumbs,
+        'CONTENT': content,
+        'SUB_PAGES': sub_pages,
+        'TOC': toc,
+        'LAST_MOD_TIME': last_mod_time,
+        'USERNAME': username,
+    }
+    values.update(extra)
+    if chunked:
+        return template.render_chunks(values)
+    return template.render(values)
+
+def timed(timings, stage, function, *args, **kwargs):
+    """
+    Calls the function and adds the time it took to the given stage of the timings dictionary.
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+    return result
+
+def generate_home_page(directory, files, subdirectories, home_content, root_directory, ignore_list, template, timings=None, analysis=None, cache=None, file_info=None, chunked=False, backlinks='', descriptions=None, renderer=None):
     """
     Generates the home page for a directory including links to subdirectories and other Markdown files.
+    If the analysis of the page's original Markdown is given, the TOC is built from it instead of rescanning.
+    With chunked, the page is returned as a list of pieces, like generate_html_from_template.
+    backlinks is the "What links here" section from backlinks_html. descriptions maps subdirectories to their
+    description, as returned by SiteModel.descriptions; without it, the description files are read.
+    The Markdown is rendered with the renderer, markdown2 by default.
     """
-    sub_pages = '<ul>'
+    if timings is None:
+        timings = {}
+    if descriptions is None:
+        descriptions = read_descriptions(directory, subdirectories)
+    items = []
     for subdir in subdirectories:
         if subdir not in ignore_list:
-            description_file = os.path.join(directory, subdir, 'description.txt')
-            if os.path.exists(description_file):
-                with open(description_file, 'r') as f:
-                    description = f.read().strip()
-                sub_pages += f'<li><a href="{subdir}/home.html"><b>{subdir.title()}</b> - {description}</a></li>'
+            description = descriptions.get(subdir)
+            if description is not None:
+                items.append(f'<li><a href="{subdir}/home.html"><b>{subdir.title()}</b> - {description}</a></li>')
             else:
-                sub_pages += f'<li><a href="{subdir}/home.html">{subdir.title()}</a></li>'
+                items.append(f'<li><a href="{subdir}/home.html">{subdir.title()}</a></li>')
 
     for file in files:
         if file != 'home.md' and file not in ignore_list:
             file_name = os.path.splitext(file)[0]
-            sub_pages += f'<li><a href="{file_name}.html">{file_name.replace("_", " ").title()}</a></li>'
-    sub_pages += '</ul>'
+            items.append(f'<li><a href="{file_name}.html">{file_name.replace("_", " ").title()}</a></li>')
+    sub_pages = '<ul>' + ''.join(items) + '</ul>'
 
     breadcrumbs = generate_breadcrumbs(directory, 'home.md', root_directory)
-    content = convert_md_to_html(home_content)
-    toc = generate_toc(home_content)
-    css_path = os.path.relpath(os.path.join(root_directory, 'styles.css'), directory).replace(os.sep, '/')
-    last_mod_time, username = get_file_info(os.path.join(directory, 'home.md'))
-    html_content = generate_html_from_template(template_path, 'Home', css_path, breadcrumbs, content, sub_pages, toc, last_mod_time, username)
+    content = render_markdown(home_content, cache, timings, renderer)
+    toc = timed(timings, 'toc', generate_toc, home_content, analysis)
+    css_path = os.path.relpath(os.path.join(root_directory, template.stylesheet), directory).replace(os.sep, '/')
+    if file_info is None:
+        file_info = timed(timings, 'file_info', get_file_info, os.path.join(directory, 'home.md'))
+    last_mod_time, username = file_info
+    return timed(timings, 'template', generate_html_from_template, template, 'Home', css_path, breadcrumbs, content, sub_pages, toc, last_mod_time, username, chunked=chunked, BACKLINKS=backlinks)
 
-    with open(os.path.join(output_dir, 'home.html'), 'w') as f:
-        f.write(html_content)
+def render_home_page(directory, files, subdirectories, home_content, root_directory, ignore_list, template, file_info, backlinks, descriptions, link_index, cache=None, renderer=None):
+    """
+    Runs the full pipeline for a directory home page. Returns the HTML, as a list of chunks, and the time spent
+    in each stage.
+    """
+    timings = {}
+    analysis = timed(timings, 'analysis', analyze_markdown, home_content)
+    link_edits = timed(timings, 'links', find_hyperlinks, home_content, analysis, 'home.md', directory, link_index)
+    home_content = apply_edits(home_content, link_edits)
+    html_content = generate_home_page(directory, files, subdirectories, home_content, root_directory, ignore_list, template, timings, analysis, cache, file_info, chunked=True, backlinks=backlinks, descriptions=descriptions, renderer=renderer)
+    return html_content, timings
+
+def render_page(directory, file, md_content, root_directory, template, file_info, backlinks, link_index, cache=None, renderer=None):
+    """
+    Runs the full pipeline for a content page. Returns the HTML, as a list of chunks, and the time spent in each stage.
+    """
+    timings = {}
+    # One tokenizing pass feeds the links, the TOC and the anchors, which are all applied in a single join
+    analysis = timed(timings, 'analysis', analyze_markdown, md_content)
+    link_edits = timed(timings, 'links', find_hyperlinks, md_content, analysis, file, directory, link_index)
+    toc = timed(timings, 'toc', generate_toc, md_content, analysis)
+    edits = link_edits + timed(timings, 'anchors', anchor_edits, analysis)
+    md_content = apply_edits(md_content, edits)
+    breadcrumbs = generate_breadcrumbs(directory, file, root_directory)
+    content = render_markdown(md_content, cache, timings, renderer)
+    page_title = os.path.splitext(file)[0].replace('_', ' ').title()
+    css_path = os.path.relpath(os.path.join(root_directory, template.stylesheet), directory).replace(os.sep, '/')
+    last_mod_time, username = file_info
+    html_content = timed(timings, 'template', generate_html_from_template, template, page_title, css_path, breadcrumbs, content, '', toc, last_mod_time, username, chunked=True, BACKLINKS=backlinks)
+    return html_content, timings
+
+_worker_link_index = None
+_worker_cache = None
+_worker_renderer = None
 
-def get_file_info(file_path):
+def _init_render_worker(link_index, cache, renderer):
+    """
+    Runs once in every pool process so the link index is sent to each worker once instead of with every page.
+    """
+    global _worker_link_index, _worker_cache, _worker_renderer
+    _worker_link_index = link_index
+    _worker_cache = cache
+    _worker_renderer = renderer
+
+def _render_in_worker(render, args):
+    return render(*args, _worker_link_index, _worker_cache, _worker_renderer)
+
+class PageWriter:
+    """
+    Renders pages inline or on a process pool, and writes every page from this process in submission order,
+    so a parallel build produces exactly the same files as a serial one. Pages are also fed to the search index
+    when there is one, and to the Compressor for their .gz/.br siblings. It also carries the build's FileMetadata cache,
+    its SiteModel, the LinkGraph pages take their backlinks from, the Prefetcher pages are read ahead with and the time
+    spent outside of pages that were rendered, in build_timings.
+    """
+    STAGES = ['read', 'search', 'prepare', 'analysis', 'links', 'toc', 'anchors', 'cache', 'markdown', 'template', 'write']
+
+    def __init__(self, link_index, jobs=1, cache=None, search_index=None, metadata=None, compressor=None, link_graph=None, site=None, renderer=None, io=None):
+        self.link_index = link_index
+        self.site = site
+        self.io = io
+        self.cache = cache
+        self.renderer = renderer
+        self.search_index = search_index
+        self.compressor = compressor
+        self.link_graph = link_graph
+        self.metadata = metadata if metadata is not None else FileMetadata()
+        self.jobs = jobs
+        self.pool = None
+        if jobs > 1:
+            self.pool = ProcessPoolExecutor(max_workers=jobs, initializer=_init_render_worker, initargs=(link_index, cache, renderer))
+        self.pending = collections.deque()
+        self.page_timings = []
+        self.build_timings = {}
+
+    def submit(self, output_file, render, *args, timings=None):
+        """
+        Renders a page with render(*args, link_index, cache, renderer) and writes the result to the output file.
+        timings holds the stages the page already went through before it was submitted.
+        """
+        if self.pool is None:
+            self._write(output_file, *render(*args, self.link_index, self.cache, self.renderer), timings)
+            return
+        self.pending.append((output_file, self.pool.submit(_render_in_worker, render, args), timings))
+        # Keep a bounded number of rendered pages waiting on the writer
+        while self.pending and (self.pending[0][1].done() or len(self.pending) > self.jobs * 4):
+            output_file, future, timings = self.pending.popleft()
+            self._write(output_file, *future.result(), timings)
+
+    def _write(self, output_file, html_content, timings, submitted_timings=None):
+        if submitted_timings:
+            timings.update(submitted_timings)
+        start = time.perf_counter()
+        write_file(output_file, html_content)
+        if self.compressor is not None:
+            self.compressor.submit(output_file, html_content)
+        else:
+            remove_compressed(output_file)  # A web server would serve stale siblings instead of the new page
+        timings['write'] = time.perf_counter() - start
+        self.page_timings.append((output_file, timings))
+
+    def flush(self):
+        """
+        Waits for and writes every page that is still being rendered.
+        """
+        while self.pending:
+            output_file, future, timings = self.pending.popleft()
+            self._write(output_file, *future.result(), timings)
+
+    def close(self):
+        """
+        Writes every page that is still being rendered and shuts the pool down.
+        """
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def cache_counts(self):
+        """
+        Returns the number of render cache hits and misses, i.e. pages timed under 'cache' and under 'markdown'.
+        """
+        hits = sum(1 for _, timings in self.page_timings if 'cache' in timings)
+        return hits, len(self.page_timings) - hits
+
+    def report(self, output_directory, top=None):
+        """
+        Prints the time in milliseconds every page spent in each stage of the pipeline, followed by the totals.
+        With top, only that many of the slowest pages are listed, slowest first, while the totals still cover every page.
+        """
+        rows = self.page_timings
+        if top is not None:
+            rows = sorted(rows, key=lambda row: sum(row[1].values()), reverse=True)[:top]
+        header = f'{"slowest pages (ms)" if top is not None else "page (ms)":<40}' + ''.join(f'{stage:>10}' for stage in self.STAGES) + f'{"total":>10}'
+        print(header)
+        totals = dict.fromkeys(self.STAGES, 0.0)
+        for _, timings in self.page_timings:
+            for stage in self.STAGES:
+                totals[stage] += timings.get(stage, 0.0)
+        for output_file, timings in rows:
+            row = f'{os.path.relpath(output_file, output_directory):<40}'
+            for stage in self.STAGES:
+                row += f'{timings.get(stage, 0.0) * 1000:>10.1f}'
+            print(row + f'{sum(timings.values()) * 1000:>10.1f}')
+        print(f'{"total (" + str(len(self.page_timings)) + " pages)":<40}' + ''.join(f'{totals[stage] * 1000:>10.1f}' for stage in self.STAGES) + f'{sum(totals.values()) * 1000:>10.1f}')
+
+def report_phases(phases):
+    """
+    Prints the wall-clock time of each phase of a build and its share of the whole build.
+    """
+    total = sum(phases.values())
+    print(f'{"build phase":<40}{"ms":>10}{"share":>10}')
+    for phase, seconds in phases.items():
+        print(f'{phase:<40}{seconds * 1000:>10.1f}{seconds / total if total else 0:>10.1%}')
+    print(f'{"total":<40}{total * 1000:>10.1f}')
+
+@functools.lru_cache(maxsize=None)
+def username_for_uid(uid):
+    """
+    Returns the name of a user. Memoized, since every lookup can be a network round-trip on NSS/LDAP hosts.
+    """
+    return pwd.getpwuid(uid).pw_name
+
+class GitMetadata:
+    """
+    Last commit date and author of every file under the root, read from the local git history in one bulk
+    'git log' pass instead of once per file. The result is cached in a JSON file and reused until HEAD moves.
+    Files with uncommitted changes or that were never committed have no git metadata.
+    """
+    def __init__(self, root_directory, cache_path):
+        self.files = {}
+        self.dirty = set()
+        self.top = self._git(root_directory, 'rev-parse', '--show-toplevel').strip()
+        head = self._git(self.top, 'rev-parse', 'HEAD').strip()
+        root = os.path.relpath(os.path.realpath(root_directory), os.path.realpath(self.top))
+
+        cached = None
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r') as f:
+                    cached = json.load(f)
+            except (OSError, ValueError):
+                cached = None
+        if cached is not None and cached.get('head') == head and cached.get('root') == root:
+            self.files = cached['files']
+        else:
+            # Commits come newest first, so the first time a path shows up is its last change
+            log = self._git(self.top, '-c', 'core.quotePath=false', 'log', '--no-renames', '--name-only', '--format=%x00%at %an', 'HEAD', '--', root)
+            for commit in log.split('\0')[1:]:
+                lines = commit.split('\n')
+                timestamp, _, author = lines[0].partition(' ')
+                for path in lines[1:]:
+                    if path and path not in self.files:
+                        self.files[path] = [int(timestamp), author]
+            write_file(cache_path, json.dumps({'head': head, 'root': root, 'files': self.files}))
+
+        status = self._git(self.top, 'status', '--porcelain=v1', '-z', '--untracked-files=no', '--', root)
+        entries = iter(status.split('\0'))
+        for entry in entries:
+            if len(entry) > 3:
+                self.dirty.add(entry[3:])
+                if entry[0] in 'RC':
+                    next(entries, None)  # Renames and copies are followed by their source path
+
+    @staticmethod
+    def _git(directory, *args):
+        return subprocess.run(['git', '-C', directory, *args], check=True, capture_output=True, text=True).stdout
+
+    def file_info(self, file_path):
+        """
+        Returns the (last modification time, author) of the file's last commit, or None.
+        """
+        path = os.path.relpath(os.path.realpath(file_path), os.path.realpath(self.top)).replace(os.sep, '/')
+        entry = self.files.get(path)
+        if entry is None or path in self.dirty:
+            return None
+        return time.ctime(entry[0]), entry[1]
+
+def load_git_metadata(root_directory, cache_dir):
+    """
+    Returns the GitMetadata of the root, or None if it isn't in a git repository. It lists every committed file
+    under the root, published or not, so it is cached in the cache directory, never in the served output,
+    in a file named after the root's path.
+    """
+    key = hashlib.sha256(os.path.realpath(root_directory).encode('utf-8')).hexdigest()[:16]
+    try:
+        os.makedirs(os.path.join(cache_dir, 'git'), exist_ok=True)
+        return GitMetadata(root_directory, os.path.join(cache_dir, 'git', key + '.json'))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'Git history unavailable, using file metadata instead. Reason: {e}')
+        return None
+
+class FileMetadata:
+    """
+    Per-build cache of os.stat results, so every source file is stat'ed once however many steps need it.
+    Directory listings fill it in as they go. With a GitMetadata, footers show the last commit instead of the
+    file's mtime and owner.
+    """
+    def __init__(self, git=None):
+        self.stats = {}
+        self.git = git
+
+    def remember(self, file_path, file_stat):
+        self.stats[file_path] = file_stat
+
+    def stat(self, file_path):
+        file_stat = self.stats.get(file_path)
+        if file_stat is None:
+            file_stat = self.stats[file_path] = os.stat(file_path)
+        return file_stat
+
+def get_file_info(file_path, metadata=None):
     """
     Get the last modification time and the user who last modified the file.
     """
     try:
+        if metadata is not None and metadata.git is not None:
+            git_info = metadata.git.file_info(file_path)
+            if git_info is not None:
+                return git_info
+
         # Get file status
-        file_stat = os.stat(file_path)
+        file_stat = metadata.stat(file_path) if metadata is not None else os.stat(file_path)
         
         # Get last modification time
         last_mod_time = time.ctime(file_stat.st_mtime)
         
         # Get user ID and username
         user_id = file_stat.st_uid
-        username = pwd.getpwuid(user_id).pw_name
+        username = username_for_uid(user_id)
         
         return last_mod_time, username
     except Exception as e:
@@ -183,52 +999,456 @@ def read_ignore_list(directory):
     """
     Reads a list of files and directories to ignore from an 'ignore.txt' file in the given directory.
     """
-    ignore_file = os.path.join(directory, 'ignore.txt')
-    if os.path.exists(ignore_file):
-        with open(ignore_file, 'r') as f:
-            ignore_list = f.read().splitlines()
-        return ignore_list
-    return []
+    # Opening it straight away saves checking that it exists first, which is a round-trip of its own on NFS
+    try:
+        with open(os.path.join(directory, 'ignore.txt'), 'r') as f:
+            return f.read().splitlines()
+    except FileNotFoundError:
+        return []
 
-def process_directory(directory, output_directory, root_directory, template_path):
+def list_directory(directory, metadata=None):
     """
-    Processes a directory to convert all Markdown files to HTML and generates the necessary HTML files for navigation.
+    Returns the ignore list, the Markdown files and the subdirectories of a directory that end up in the wiki.
+    The directory is read with a single os.scandir, and the stat of every Markdown file goes into the metadata cache.
     """
     ignore_list = read_ignore_list(directory)
+    files = []
+    subdirectories = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name in ignore_list:
+                continue
+            if entry.name.endswith('.md') and entry.is_file():
+                files.append(entry.name)
+                if metadata is not None:
+                    metadata.remember(entry.path, entry.stat())
+            elif not entry.name.startswith('.') and entry.is_dir():
+                subdirectories.append(entry.name)
+    return ignore_list, sorted(files), sorted(subdirectories)
 
-    files = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f)) and f.endswith('.md') and f not in ignore_list]
-    subdirectories = [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)) and not d.startswith('.') and d not in ignore_list]
+def page_url_and_title(directory, file, root_directory):
+    """
+    Returns the path of a page's output relative to the output root, which the search index and the link graph
+    know it by, and the title it is listed under there.
+    """
+    relative_directory = os.path.relpath(directory, root_directory)
+    url = posixpath.normpath(posixpath.join(relative_directory.replace(os.sep, '/'), os.path.splitext(file)[0] + '.html'))
+    if file == 'home.md':
+        title = 'Home' if relative_directory == '.' else f'{os.path.basename(directory).title()} Home'
+    else:
+        title = os.path.splitext(file)[0].replace('_', ' ').title()
+    return url, title
 
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
+def backlinks_html(backlinks, directory, root_directory):
+    """
+    Returns the "What links here" section listing the (url, title) backlinks of a page, or '' if it has none.
+    """
+    if not backlinks:
+        return ''
+    relative_directory = os.path.relpath(directory, root_directory).replace(os.sep, '/')
+    items = ''.join(f'<li><a href="{posixpath.relpath(url, relative_directory)}">{title}</a></li>' for url, title in backlinks)
+    return f'<section class="backlinks"><h2>What links here</h2><ul>{items}</ul></section>'
 
-    if 'home.md' in files:
-        with open(os.path.join(directory, 'home.md'), 'r') as f:
-            home_content = f.read()
-        home_content = create_hyperlinks(home_content, files, 'home.md', directory, root_directory)
-        generate_home_page(directory, files, subdirectories, home_content, output_directory, root_directory, ignore_list, template_path)
+def read_text(file_path):
+    with open(file_path, 'r') as f:
+        return f.read()
 
-    for file in files:
-        if file != 'home.md':
-            with open(os.path.join(directory, file), 'r') as f:
-                md_content = f.read()
-            md_content = create_hyperlinks(md_content, files, file, directory, root_directory)
-            toc = generate_toc(md_content)
-            md_content = add_anchors(md_content)
-            breadcrumbs = generate_breadcrumbs(directory, file, root_directory)
-            content = convert_md_to_html(md_content)
-            page_title = os.path.splitext(file)[0].replace('_', ' ').title()
-            css_path = os.path.relpath(os.path.join(root_directory, 'styles.css'), directory).replace(os.sep, '/')
-            last_mod_time, username = get_file_info(os.path.join(directory, file))
-            html_content = generate_html_from_template(template_path, page_title, css_path, breadcrumbs, content, '', toc, last_mod_time, username)
-            html_file = os.path.join(output_directory, os.path.splitext(file)[0] + '.html')
-            with open(html_file, 'w') as f:
-                f.write(html_content)
+def build_page(directory, file, output_directory, root_directory, template, manifest, writer, listing, md_content=None):
+    """
+    Reads one Markdown file and submits it to the writer, unless the manifest shows its output is up to date.
+    listing is the (ignore_list, files, subdirectories) tuple of the directory, which home pages are built from.
+    md_content is the text of the file when it has already been read ahead.
+    """
+    timings = {}
+    file_path = os.path.join(directory, file)
+    if md_content is None:
+        md_content = timed(timings, 'read', read_text, file_path)
+    html_file = os.path.join(output_directory, os.path.splitext(file)[0] + '.html')
+    ignore_list, files, subdirectories = listing
+    url, title = page_url_and_title(directory, file, root_directory)
+    if writer.search_index is not None:
+        # The index skips pages whose text it has already seen, independently of the manifest
+        timed(timings, 'search', writer.search_index.add_page, url, title, md_content)
+    start = time.perf_counter()
+    backlinks = ''
+    if writer.link_graph is not None:
+        backlinks = backlinks_html(writer.link_graph.backlinks(url), directory, root_directory)
+    if manifest is not None:
+        # The links a page resolves to are part of its inputs, so adding or renaming a page
+        # only invalidates the pages that mention it
+        link_edits = find_hyperlinks(md_content, analyze_markdown(md_content), file, directory, writer.link_index)
+    # The footer metadata is resolved here, from the cached stat, so render workers never stat or look up users
+    file_info = get_file_info(file_path, writer.metadata)
+    if file == 'home.md':
+        if writer.site is not None and directory in writer.site.directories:
+            descriptions = writer.site.descriptions(directory)
+        else:
+            descriptions = read_descriptions(directory, subdirectories)
+    if manifest is not None:
+        if file == 'home.md':
+            digest = home_page_digest(directory, files, subdirectories, md_content, ignore_list, link_edits, file_info, backlinks, descriptions)
+        else:
+            digest = page_digest(file_info, md_content, link_edits, backlinks)
+        if not manifest.needs_build(html_file, digest):
+            if writer.compressor is not None:
+                writer.compressor.submit_missing(html_file)
+            timings['prepare'] = time.perf_counter() - start
+            writer.build_timings['unchanged pages'] = writer.build_timings.get('unchanged pages', 0.0) + sum(timings.values())
+            return
+    timings['prepare'] = time.perf_counter() - start
+    if file == 'home.md':
+        writer.submit(html_file, render_home_page, directory, files, subdirectories, md_content, root_directory, ignore_list, template, file_info, backlinks, descriptions, timings=timings)
+    else:
+        writer.submit(html_file, render_page, directory, file, md_content, root_directory, template, file_info, backlinks, timings=timings)
 
-    for subdir in subdirectories:
-        subdir_input = os.path.join(directory, subdir)
-        subdir_output = os.path.join(output_directory, subdir)
-        process_directory(subdir_input, subdir_output, root_directory, template_path)
+def read_description(directory):
+    """
+    Returns the text of a directory's description.txt, or None if it has none.
+    """
+    try:
+        with open(os.path.join(directory, 'description.txt'), 'r') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def read_descriptions(directory, subdirectories):
+    """
+    Returns the description of every subdirectory, None for those without one.
+    """
+    return {subdir: read_description(os.path.join(directory, subdir)) for subdir in subdirectories}
+
+def scan_directory(directory, metadata=None):
+    """
+    Returns the listing of a directory, as list_directory does, and its description.
+    """
+    return list_directory(directory, metadata), read_description(directory)
+
+class DirectoryModel:
+    """
+    One published directory of the wiki. url is its path relative to the root with a trailing slash ('' for the root),
+    listing its (ignore_list, files, subdirectories) tuple and pages the (file, url, title) of its pages, home page first.
+    """
+    def __init__(self, path, url, title, listing, description, pages):
+        self.path = path
+        self.url = url
+        self.title = title
+        self.listing = listing
+        self.description = description
+        self.pages = pages
+
+class SiteModel:
+    """
+    Every published directory of the wiki with its pages, subdirectories and description, listed and read once per
+    run. The directories are kept in build order, depth-first with sorted names, and drive the walk over the pages,
+    the listings on home pages and the site index files. The tree is walked with an explicit stack, so it can be
+    deeper than the recursion limit. With a Prefetcher, subdirectories are listed as soon as their parent is.
+    """
+    def __init__(self, root_directory, metadata=None, io=None):
+        self.root_directory = root_directory
+        self.directories = {}
+        stack = [root_directory]
+        scans = {}
+        while stack:
+            directory = stack.pop()
+            scan = scans.pop(directory, None)
+            listing, description = scan.result() if scan is not None else scan_directory(directory, metadata)
+            files, subdirectories = listing[1], listing[2]
+            relative_directory = os.path.relpath(directory, root_directory)
+            if relative_directory == '.':
+                url, title = '', 'Home'
+            else:
+                url, title = relative_directory.replace(os.sep, '/') + '/', os.path.basename(directory).title()
+            ordered = (['home.md'] if 'home.md' in files else []) + [file for file in files if file != 'home.md']
+            pages = [(file,) + page_url_and_title(directory, file, root_directory) for file in ordered]
+            self.directories[directory] = DirectoryModel(directory, url, title, listing, description, pages)
+            # Pushed in reverse so they are popped, and built, in sorted order
+            for subdir in reversed(subdirectories):
+                stack.append(os.path.join(directory, subdir))
+            if io is not None:
+                for subdir in subdirectories:
+                    subdirectory = os.path.join(directory, subdir)
+                    scans[subdirectory] = io.submit(scan_directory, subdirectory, metadata)
+
+    def descriptions(self, directory):
+        """
+        Returns the description of every subdirectory of a directory, None for those without one.
+        """
+        return {subdir: self.directories[os.path.join(directory, subdir)].description for subdir in self.directories[directory].listing[2]}
+
+    def index(self):
+        """
+        Returns the JSON site index: every directory with its title, description, pages and subdirectories.
+        """
+        directories = []
+        for directory in self.directories.values():
+            directories.append({
+                'url': directory.url,
+                'title': directory.title,
+                'description': directory.description,
+                'pages': [{'url': url, 'title': title} for _, url, title in directory.pages],
+                'subdirectories': [directory.url + subdir + '/' for subdir in directory.listing[2]],
+            })
+        return {'directories': directories}
+
+    def sitemap(self, base_url):
+        """
+        Returns a sitemap.xml listing the URL of every page under base_url.
+        """
+        base_url = base_url.rstrip('/') + '/'
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
+        for directory in self.directories.values():
+            for _, url, _ in directory.pages:
+                lines.append(f'  <url><loc>{xml_escape(base_url + urllib.parse.quote(url))}</loc></url>')
+        lines.append('</urlset>')
+        return '\n'.join(lines) + '\n'
+
+def write_site_index(site, output_directory, base_url=None):
+    """
+    Writes site.json and, with a base URL, sitemap.xml to the output root, unless they are unchanged.
+    Returns the paths of the files that were written.
+    """
+    outputs = [('site.json', json.dumps(site.index(), separators=(',', ':')))]
+    if base_url:
+        outputs.append(('sitemap.xml', site.sitemap(base_url)))
+    written = []
+    for name, content in outputs:
+        file_path = os.path.join(output_directory, name)
+        try:
+            with open(file_path, 'r') as f:
+                if f.read() == content:
+                    continue
+        except FileNotFoundError:
+            pass
+        write_file(file_path, content)
+        written.append(file_path)
+    return written
+
+def walk_pages(site, output_directory=None):
+    """
+    Yields (directory, file, output_directory, listing) for every page of the site model in build order, creating
+    output directories as it goes. Without an output directory, None is yielded in its place.
+    """
+    for directory in site.directories.values():
+        page_output_directory = None
+        if output_directory is not None:
+            page_output_directory = os.path.normpath(os.path.join(output_directory, os.path.relpath(directory.path, site.root_directory)))
+            if not os.path.exists(page_output_directory):
+                os.makedirs(page_output_directory)
+        for file, _, _ in directory.pages:
+            yield directory.path, file, page_output_directory, directory.listing
+
+def process_directory(directory, output_directory, root_directory, template, manifest=None, link_index=None, writer=None):
+    """
+    Processes a directory to convert all Markdown files to HTML and generates the necessary HTML files for navigation.
+    If a manifest is given, pages whose inputs have not changed since the last build are skipped.
+    Pages are rendered and written through the writer, which renders inline when none is given. Pages stream
+    through one at a time, plus the few a parallel writer keeps in flight. The directories are taken from the
+    writer's SiteModel, which is built from the directory when it has none. With the writer's Prefetcher, pages are
+    read a few per thread ahead of the one being built.
+    """
+    if writer is None:
+        writer = PageWriter(link_index or LinkIndex(root_directory))
+        process_directory(directory, output_directory, root_directory, template, manifest, writer.link_index, writer)
+        writer.close()
+        return
+    if writer.site is None:
+        writer.site = SiteModel(directory, writer.metadata, writer.io)
+    if writer.io is None:
+        for page_directory, file, page_output_directory, listing in walk_pages(writer.site, output_directory):
+            build_page(page_directory, file, page_output_directory, root_directory, template, manifest, writer, listing)
+        return
+    pages = writer.io.map(lambda page: page + (read_text(os.path.join(page[0], page[1])),), walk_pages(writer.site, output_directory))
+    for page_directory, file, page_output_directory, listing, md_content in pages:
+        build_page(page_directory, file, page_output_directory, root_directory, template, manifest, writer, listing, md_content)
+
+def update_link_graph(link_graph, site, link_index, metadata, io=None):
+    """
+    Brings the link graph up to date with every published page before any page is rendered, since a page's
+    backlinks depend on pages built after it. Only pages that changed are read and scanned for links, on the
+    Prefetcher when there is one. Returns the set of urls whose backlinks changed.
+    """
+    pages = []
+    sources = {}
+    for directory in site.directories.values():
+        for file, url, title in directory.pages:
+            file_stat = metadata.stat(os.path.join(directory.path, file))
+            pages.append((url, title, (file_stat.st_mtime_ns, file_stat.st_size)))
+            sources[url] = (directory.path, file)
+
+    def find_targets(url):
+        directory, file = sources[url]
+        with open(os.path.join(directory, file), 'r') as f:
+            md_content = f.read()
+        return linked_pages(md_content, analyze_markdown(md_content), file, link_index)
+
+    links_digest = hashlib.sha256(json.dumps(link_index.links, sort_keys=True).encode('utf-8')).hexdigest()
+    changed, rescanned = link_graph.update(pages, links_digest, find_targets, functools.partial(prefetch_map, io))
+    print(f'Link graph: rescanned {rescanned} pages, backlinks changed on {len(changed)} pages')
+    return changed
+
+def page_digest(file_info, md_content, link_edits, backlinks=''):
+    """
+    Hashes everything a content page is rendered from: its Markdown, the links it resolves to,
+    the (last modification time, username) shown in the footer and its backlinks section.
+    """
+    hasher = hashlib.sha256(md_content.encode('utf-8'))
+    hasher.update(f'{file_info[0]}:{file_info[1]}'.encode('utf-8'))
+    hasher.update(backlinks.encode('utf-8'))
+    for start, end, replacement in link_edits:
+        hasher.update(f'{start}:{end}:{replacement}\n'.encode('utf-8'))
+    return hasher.hexdigest()
+
+def home_page_digest(directory, files, subdirectories, home_content, ignore_list, link_edits, file_info, backlinks='', descriptions=None):
+    """
+    Hashes the inputs of a directory home page, which also lists its files and subdirectory descriptions.
+    """
+    if descriptions is None:
+        descriptions = read_descriptions(directory, subdirectories)
+    hasher = hashlib.sha256(page_digest(file_info, home_content, link_edits, backlinks).encode('utf-8'))
+    for file in sorted(files):
+        hasher.update(f'file:{file}\n'.encode('utf-8'))
+    for subdir in sorted(subdirectories):
+        hasher.update(f'dir:{subdir}\n'.encode('utf-8'))
+        if subdir not in ignore_list and descriptions.get(subdir) is not None:
+            hasher.update(f'description:{descriptions[subdir]}\n'.encode('utf-8'))
+    return hasher.hexdigest()
+
+def scan_entries(dirpath):
+    """
+    Returns the sorted (name, is_dir, is_symlink) entries of a directory, or None if it can't be read.
+    """
+    try:
+        with os.scandir(dirpath) as scanned:
+            return sorted((entry.name, entry.is_dir(), entry.is_symlink()) for entry in scanned)
+    except OSError:
+        return None
+
+def walk_tree(top, io=None):
+    """
+    Like os.walk, yields (dirpath, dirnames, filenames) top-down without following symlinked directories,
+    but with sorted names and an explicit stack, since os.walk recurses once per directory level.
+    As with os.walk, removing names from dirnames keeps the walk out of those directories.
+    With a Prefetcher, subdirectories are scanned as soon as their parent is, but yielded in the same order.
+    """
+    stack = [top]
+    scans = {}
+    while stack:
+        dirpath = stack.pop()
+        scan = scans.pop(dirpath, None)
+        entries = scan.result() if scan is not None else scan_entries(dirpath)
+        if entries is None:
+            continue
+        dirnames = [name for name, is_dir, _ in entries if is_dir]
+        yield dirpath, dirnames, [name for name, is_dir, _ in entries if not is_dir]
+        symlinks = {name for name, _, is_symlink in entries if is_symlink}
+        subdirectories = [os.path.join(dirpath, name) for name in dirnames if name not in symlinks]
+        stack.extend(reversed(subdirectories))
+        if io is not None:
+            for subdirectory in subdirectories:
+                scans[subdirectory] = io.submit(scan_entries, subdirectory)
+
+def collect_link_targets(root_directory, io=None):
+    """
+    Returns the paths, relative to the root, of every Markdown file that other pages can link to.
+    The tree is walked top-down in sorted order so the result is the same on every run.
+    """
+    targets = []
+    for dirpath, _, filenames in walk_tree(root_directory, io):
+        for filename in filenames:
+            if filename.endswith('.md'):
+                targets.append(os.path.relpath(os.path.join(dirpath, filename), root_directory).replace(os.sep, '/'))
+    return targets
+
+def build_digest(template, renderer):
+    """
+    Hashes the inputs shared by every page, including the Markdown renderer. When this changes, every page has to be rebuilt.
+    """
+    hasher = hashlib.sha256(f'version:{MANIFEST_VERSION}\nstylesheet:{template.stylesheet}\nrenderer:{renderer.key}\n'.encode('utf-8'))
+    hasher.update(template.source.encode('utf-8'))
+    return hasher.hexdigest()
+
+class BuildManifest:
+    """
+    Records the input digest of every generated page so that the next build only re-renders what changed.
+    """
+    def __init__(self, output_directory, digest):
+        self.output_directory = output_directory
+        self.path = os.path.join(output_directory, MANIFEST_NAME)
+        self.digest = digest
+        self.exists = os.path.exists(self.path)
+        self.previous = {}
+        self.current = {}
+        self.reusable = False
+        self.built = 0
+        self.skipped = 0
+        if self.exists:
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                self.previous = data.get('pages', {})
+                self.reusable = data.get('digest') == digest
+            except (OSError, ValueError) as e:
+                print(f'Ignoring unreadable manifest {self.path}. Reason: {e}')
+                self.exists = False
+
+    def needs_build(self, output_file, digest):
+        """
+        Records the digest for an output file and returns whether the file has to be regenerated.
+        """
+        key = os.path.relpath(output_file, self.output_directory).replace(os.sep, '/')
+        self.current[key] = digest
+        if self.reusable and self.previous.get(key) == digest and os.path.exists(output_file):
+            self.skipped += 1
+            return False
+        self.built += 1
+        return True
+
+    def remove_orphans(self):
+        """
+        Deletes outputs from the previous build whose source pages no longer exist, along with emptied directories.
+        """
+        removed = 0
+        for key in self.previous:
+            if key in self.current:
+                continue
+            file_path = os.path.join(self.output_directory, key)
+            try:
+                if remove_output(file_path):
+                    removed += 1
+                parent = os.path.dirname(file_path)
+                while parent != self.output_directory and os.path.isdir(parent) and not os.listdir(parent):
+                    os.rmdir(parent)
+                    parent = os.path.dirname(parent)
+            except OSError as e:
+                print(f'Failed to delete {file_path}. Reason: {e}')
+        return removed
+
+    def carry_over(self):
+        """
+        Starts a partial build: every output of the previous build is kept unless it is rebuilt or forgotten.
+        """
+        self.current = dict(self.previous)
+
+    def forget(self, output_file):
+        """
+        Deletes an output whose source page is gone and drops it from the manifest.
+        """
+        key = os.path.relpath(output_file, self.output_directory).replace(os.sep, '/')
+        tracked = self.previous.pop(key, None) is not None
+        tracked = self.current.pop(key, None) is not None or tracked
+        if tracked:
+            remove_output(output_file)
+
+    def save(self):
+        """
+        Writes the manifest for the build that just finished. Later builds in the same process compare against it.
+        """
+        write_file(self.path, json.dumps({'digest': self.digest, 'pages': self.current}, indent=1, sort_keys=True))
+        self.previous = dict(self.current)
+        self.reusable = True
+        self.exists = True
+        self.built = 0
+        self.skipped = 0
 
 def clear_directory(directory):
     """
@@ -244,17 +1464,644 @@ def clear_directory(directory):
         except Exception as e:
             print(f'Failed to delete {file_path}. Reason: {e}')
 
-def add_css(source_directory, output_directory):
+STYLESHEET = re.compile(r'styles(\.[0-9a-f]+)?\.css(\.gz|\.br)?')
+
+def stylesheet_name(css_content):
+    """
+    Returns the content-hashed name the stylesheet is published under, e.g. styles.3f2a9c01d4.css.
+    The name changes whenever the CSS does, so the file can be served with a far-future cache lifetime.
+    """
+    return f'styles.{hashlib.sha256(css_content).hexdigest()[:10]}.css'
+
+def load_template(html_src_directory):
+    """
+    Loads template.html and points it at the fingerprinted name of styles.css.
+    """
+    template = Template.load(os.path.join(html_src_directory, 'template.html'))
+    with open(os.path.join(html_src_directory, 'styles.css'), 'rb') as f:
+        template.stylesheet = stylesheet_name(f.read())
+    return template
+
+def add_css(source_directory, output_directory, compressor=None):
     """
-    Copies the CSS file from the source directory to the output directory.
+    Copies the CSS file from the source directory to the output directory under its fingerprinted name.
+    Returns that name.
     """
-    shutil.copyfile(os.path.join(source_directory, 'styles.css'), os.path.join(output_directory, 'styles.css'))
+    with open(os.path.join(source_directory, 'styles.css'), 'rb') as f:
+        css_content = f.read()
+    name = stylesheet_name(css_content)
+    css_path = os.path.join(output_directory, name)
+    # The name is the content, so a file that is already there is up to date
+    if not os.path.exists(css_path):
+        write_file(css_path, css_content)
+    if compressor is not None and not has_compressed(css_path):
+        compressor.submit(css_path, css_content)
+    return name
+
+def remove_stale_stylesheets(output_directory, current):
+    """
+    Deletes the stylesheets of earlier builds, once no page refers to them anymore.
+    """
+    for name in os.listdir(output_directory):
+        match = STYLESHEET.fullmatch(name)
+        if match and name[:len(name) - len(match.group(2) or '')] != current:
+            os.unlink(os.path.join(output_directory, name))
+
+def unchanged_outputs(output_directory):
+    """
+    Returns the paths of the outputs that aren't pages or the stylesheet and that a build may leave unchanged:
+    the site index, the link graph and the files of the search index.
+    """
+    file_paths = [os.path.join(output_directory, name) for name in ('site.json', 'sitemap.xml', 'graph.json')]
+    search_directory = os.path.join(output_directory, 'search')
+    if os.path.isdir(search_directory):
+        file_paths.extend(os.path.join(search_directory, name) for name in sorted(os.listdir(search_directory)) if name.endswith('.json'))
+    return file_paths
+
+def search_state_directory(cache_dir):
+    """
+    Returns the directory the search index keeps its build state in, out of the served output.
+    """
+    return os.path.join(cache_dir, 'search')
+
+def build(root_directory, html_src_directory, output_directory, incremental=False, jobs=1, timings=False, cache=None, search=True, git=False, compress=True, profile=None, backlinks=True, base_url=None, renderer=None, io_threads=8, cache_dir=CACHE_DIRECTORY):
+    """
+    Builds the whole wiki. Incremental builds keep a manifest in the output directory, only re-render pages
+    whose inputs changed and only delete outputs that no longer have a source page.
+    With more than one job, pages are rendered on a process pool. A RenderCache lets pages whose processed
+    Markdown was seen by an earlier build skip the renderer, the MarkdownRenderer of the backend pages are
+    rendered with (markdown2 by default). With search, a full-text index of every page is kept
+    up to date in the 'search' directory of the output, with its build state in the cache directory.
+    With git, footers show each page's last commit, read from a git log cached in the cache directory.
+    With compress, every file the build writes gets precompressed .gz/.br siblings. With backlinks, every page gets
+    a "What links here" section and the link graph of the whole wiki is written to graph.json. site.json describes
+    every directory and page, and with a base URL, sitemap.xml lists every page.
+    With more than one I/O thread, the tree is listed and pages are read ahead of the build on a Prefetcher.
+    With profile, prints how long each phase of the build took and the profile slowest pages with their stages.
+    Page stages are summed over render workers, so with several jobs they add up to more than the wall clock.
+    Returns how many pages were rendered.
+    """
+    phases = {}
+    start = time.perf_counter()
+    if renderer is None:
+        renderer = get_renderer()
+    template = load_template(html_src_directory)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    manifest = None
+    if incremental:
+        manifest = BuildManifest(output_directory, build_digest(template, renderer))
+        if not manifest.exists:
+            # Without a previous manifest we can't tell our outputs apart from stale ones
+            clear_directory(output_directory)
+    else:
+        clear_directory(output_directory)
+
+    compressor = Compressor() if compress else None
+    add_css(html_src_directory, output_directory, compressor)
+    search_index = SearchIndexWriter(output_directory, search_state_directory(cache_dir)) if search else None
+    remove_output(os.path.join(output_directory, LEGACY_GIT_METADATA_NAME))
+    metadata = FileMetadata(load_git_metadata(root_directory, cache_dir) if git else None)
+    io = Prefetcher(io_threads) if io_threads > 1 else None
+    phases['setup'] = time.perf_counter() - start
+    try:
+        site = timed(phases, 'walk', SiteModel, root_directory, metadata, io)
+        link_index = timed(phases, 'link index', LinkIndex, root_directory, io)
+        link_graph = None
+        if backlinks:
+            link_graph = LinkGraph(output_directory)
+            timed(phases, 'link graph', update_link_graph, link_graph, site, link_index, metadata, io)
+        writer = PageWriter(link_index, jobs, cache, search_index, metadata, compressor, link_graph, site, renderer, io)
+        try:
+            timed(phases, 'rendered pages', process_directory, root_directory, output_directory, root_directory, template, manifest, link_index, writer)
+        finally:
+            timed(phases, 'rendered pages', writer.close)
+        if search_index is not None:
+            print(f'Search index: re-indexed {timed(phases, "search index", search_index.finish)} pages')
+            compress_outputs(compressor, search_index.written)
+        if link_graph is not None:
+            compress_outputs(compressor, timed(phases, 'link graph', link_graph.save))
+        compress_outputs(compressor, timed(phases, 'site index', write_site_index, site, output_directory, base_url))
+        if compressor is not None:
+            # Outputs other than pages that this build left unchanged
+            for file_path in unchanged_outputs(output_directory):
+                compressor.submit_missing(file_path)
+    finally:
+        if io is not None:
+            io.close()
+        if compressor is not None:
+            timed(phases, 'compression', compressor.close)
+    if compressor is not None:
+        print(f'Compressed {compressor.count} files')
+    if timings:
+        writer.report(output_directory)
+    start = time.perf_counter()
+    remove_stale_stylesheets(output_directory, template.stylesheet)
+    if cache is not None:
+        hits, misses = writer.cache_counts()
+        print(f'Render cache: {hits} hits, {misses} misses, evicted {cache.evict()} entries')
+
+    if manifest is not None:
+        removed = manifest.remove_orphans()
+        print(f'Built {manifest.built} pages, skipped {manifest.skipped} unchanged pages, removed {removed} orphaned pages')
+        manifest.save()
+    phases['cleanup'] = time.perf_counter() - start
+    if profile:
+        # Unchanged pages are prepared while the rendered pages go through
+        phases['rendered pages'] -= sum(writer.build_timings.values())
+        phases.update(writer.build_timings)
+        report_phases(phases)
+        writer.report(output_directory, profile)
+    return len(writer.page_timings)
+
+def file_signature(file_path):
+    """
+    Returns the (mtime_ns, size) of a file, or None if it is gone.
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None  # Deleted while we were walking
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+def snapshot_tree(root_directory, io=None):
+    """
+    Returns the set of directories and a {path: (mtime_ns, size)} dictionary of the files under the root.
+    Like the build, it leaves out hidden directories and whatever an ignore.txt lists, so changes in there,
+    e.g. to the .git directory of a notes checkout, are never watched and never trigger a rebuild.
+    With a Prefetcher, the directories are scanned and the files stat'ed concurrently.
+    """
+    directories = set()
+    file_paths = []
+    for dirpath, dirnames, filenames in walk_tree(root_directory, io):
+        directories.add(dirpath)
+        ignore_list = read_ignore_list(dirpath)
+        dirnames[:] = [name for name in dirnames if not name.startswith('.') and name not in ignore_list]
+        file_paths.extend(os.path.join(dirpath, filename) for filename in filenames if filename not in ignore_list)
+    files = {}
+    for file_path, signature in zip(file_paths, prefetch_map(io, file_signature, file_paths)):
+        if signature is not None:
+            files[file_path] = signature
+    return directories, files
+
+def is_published(file_path, root_directory):
+    """
+    Returns whether a Markdown file is turned into a page, i.e. neither it nor any directory above it
+    is hidden or listed in an ignore.txt.
+    """
+    directory = os.path.dirname(file_path)
+    name = os.path.basename(file_path)
+    while True:
+        if name in read_ignore_list(directory):
+            return False
+        if directory == root_directory or not directory.startswith(root_directory):
+            return True
+        name = os.path.basename(directory)
+        if name.startswith('.'):
+            return False
+        directory = os.path.dirname(directory)
+
+class WikiWatcher:
+    """
+    Keeps the output up to date while the notes are edited. Edited pages are re-rendered on their own. When a page
+    is added, removed or renamed, only the pages that mention its title and the home page listing it are looked at,
+    and of those only the ones whose resolved links actually changed are re-rendered.
+    Uses inotify when the optional inotify_simple package is installed and polls the tree otherwise.
+    """
+    DEBOUNCE = 0.1  # Seconds to wait for an editor to finish a burst of writes
+
+    def __init__(self, root_directory, html_src_directory, output_directory, jobs=1, interval=0.5, cache=None, search=True, git=False, compress=True, backlinks=True, base_url=None, renderer=None, io_threads=8, cache_dir=CACHE_DIRECTORY):
+        self.root_directory = os.path.abspath(root_directory)
+        self.html_src_directory = html_src_directory
+        self.output_directory = output_directory
+        self.jobs = jobs
+        self.cache = cache
+        self.search = search
+        self.git = git
+        self.compress = compress
+        self.backlinks = backlinks
+        self.base_url = base_url
+        self.renderer = renderer if renderer is not None else get_renderer()
+        self.io_threads = io_threads
+        self.cache_dir = cache_dir
+        self.io = Prefetcher(io_threads) if io_threads > 1 else None
+        self.interval = interval
+        self.inotify = None
+        self.watched = set()
+        if INotify is not None:
+            self.inotify = INotify()
+
+    def full_build(self):
+        """
+        Runs an incremental build of the whole tree and reloads everything the partial rebuilds rely on.
+        Returns how many pages were rendered.
+        """
+        built = build(self.root_directory, self.html_src_directory, self.output_directory, incremental=True, jobs=self.jobs, cache=self.cache, search=self.search, git=self.git, compress=self.compress, backlinks=self.backlinks, base_url=self.base_url, renderer=self.renderer, io_threads=self.io_threads, cache_dir=self.cache_dir)
+        self.template = load_template(self.html_src_directory)
+        self.link_index = LinkIndex(self.root_directory, self.io)
+        self.manifest = BuildManifest(self.output_directory, build_digest(self.template, self.renderer))
+        self.search_index = SearchIndexWriter(self.output_directory, search_state_directory(self.cache_dir)) if self.search else None
+        self.link_graph = LinkGraph(self.output_directory) if self.backlinks else None
+        self.site = SiteModel(self.root_directory, io=self.io)
+        self.directories, self.files = snapshot_tree(self.root_directory, self.io)
+        # Lowercased text of every page, to find the pages that mention a title that was added or removed
+        self.texts = {}
+        md_files = [file_path for file_path in self.files if file_path.endswith('.md')]
+        for file_path, text in zip(md_files, prefetch_map(self.io, self._read_lowercase, md_files)):
+            if text is not None:
+                self.texts[file_path] = text
+        return built
+
+    @staticmethod
+    def _read_lowercase(file_path):
+        try:
+            with open(file_path, 'r') as f:
+                return f.read().lower()
+        except OSError:
+            return None
+
+    def _load_text(self, file_path):
+        text = self._read_lowercase(file_path)
+        if text is not None:
+            self.texts[file_path] = text
+        else:
+            self.texts.pop(file_path, None)
+
+    def _output_file(self, file_path):
+        relative_path = os.path.relpath(file_path, self.root_directory)
+        return os.path.join(self.output_directory, os.path.splitext(relative_path)[0] + '.html')
+
+    def _wait(self):
+        """
+        Blocks until something under the root might have changed.
+        """
+        if self.inotify is None:
+            time.sleep(self.interval)
+            return
+        for directory in self.directories - self.watched:
+            try:
+                self.inotify.add_watch(directory, inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MODIFY
+                                       | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO)
+                self.watched.add(directory)
+            except OSError:
+                pass
+        self.watched &= self.directories  # The kernel drops watches of deleted directories by itself
+        self.inotify.read()
+        time.sleep(self.DEBOUNCE)
+        self.inotify.read(timeout=0)
+
+    def rebuild(self, directories, files):
+        """
+        Brings the output up to date with a new snapshot of the tree and returns how many pages were rendered.
+        """
+        changed = {path for path in files.keys() | self.files.keys() if files.get(path) != self.files.get(path)}
+        if directories != self.directories or any(os.path.basename(path) == 'ignore.txt' for path in changed):
+            # Whole subtrees may have appeared or disappeared
+            return self.full_build()
+
+        added_or_removed = {path for path in changed if (path in files) != (path in self.files)}
+        self.files = files
+        self.manifest.carry_over()
+        candidates = set()
+        for path in changed:
+            if path.endswith('.md'):
+                if path in files:
+                    self._load_text(path)
+                    candidates.add(path)
+                else:
+                    self.texts.pop(path, None)
+                    self.manifest.forget(self._output_file(path))
+                    if self.search_index is not None:
+                        self.search_index.remove_page(os.path.relpath(self._output_file(path), self.output_directory).replace(os.sep, '/'))
+                if path in added_or_removed:
+                    # The home page of the directory lists its pages
+                    candidates.add(os.path.join(os.path.dirname(path), 'home.md'))
+            elif os.path.basename(path) == 'description.txt':
+                candidates.add(os.path.join(os.path.dirname(os.path.dirname(path)), 'home.md'))
+
+        if any(path.endswith('.md') for path in added_or_removed):
+            link_index = LinkIndex(self.root_directory, self.io)
+            old_links = self.link_index.links
+            changed_keys = {key for key in old_links.keys() | link_index.links.keys() if old_links.get(key) != link_index.links.get(key)}
+            self.link_index = link_index
+            # A page can only link to or from a changed title if it mentions it. Pages that mention it without
+            # resolving to a different link keep their digest and are skipped by the manifest.
+            for path, text in self.texts.items():
+                if any(key in text for key in changed_keys):
+                    candidates.add(path)
+
+        metadata = FileMetadata(load_git_metadata(self.root_directory, self.cache_dir) if self.git else None)
+        site_changed = added_or_removed or any(os.path.basename(path) == 'description.txt' for path in changed)
+        if site_changed:
+            self.site = SiteModel(self.root_directory, metadata, self.io)
+        if self.link_graph is not None:
+            # Pages whose backlinks changed have to be re-rendered too
+            for url in update_link_graph(self.link_graph, self.site, self.link_index, metadata, self.io):
+                candidates.add(os.path.join(self.root_directory, *os.path.splitext(url)[0].split('/')) + '.md')
+        compressor = Compressor() if self.compress else None
+        writer = PageWriter(self.link_index, self.jobs, self.cache, self.search_index, metadata, compressor, self.link_graph, self.site, self.renderer, self.io)
+        try:
+            try:
+                for path in sorted(candidates):
+                    if path not in files or not is_published(path, self.root_directory):
+                        continue
+                    output_directory = os.path.dirname(self._output_file(path))
+                    if not os.path.exists(output_directory):
+                        os.makedirs(output_directory)
+                    directory = os.path.dirname(path)
+                    build_page(directory, os.path.basename(path), output_directory, self.root_directory, self.template,
+                               self.manifest, writer, list_directory(directory, writer.metadata))
+            finally:
+                writer.close()
+            self.manifest.save()
+            if self.search_index is not None:
+                self.search_index.finish(prune=False)
+                compress_outputs(compressor, self.search_index.written)
+            if self.link_graph is not None:
+                compress_outputs(compressor, self.link_graph.save())
+            if site_changed:
+                compress_outputs(compressor, write_site_index(self.site, self.output_directory, self.base_url))
+        finally:
+            if compressor is not None:
+                compressor.close()
+        return len(writer.page_timings)
+
+    def run(self):
+        self.full_build()
+        print(f'Watching {self.root_directory} ({"inotify" if self.inotify else "polling"})')
+        while True:
+            self._wait()
+            directories, files = snapshot_tree(self.root_directory, self.io)
+            if directories == self.directories and files == self.files:
+                continue
+            start = time.perf_counter()
+            built = self.rebuild(directories, files)
+            print(f'Rebuilt {built} pages in {(time.perf_counter() - start) * 1000:.0f} ms')
+
+def link_tree(source_directory, destination_directory):
+    """
+    Recreates a directory tree with hard links to the source's files, falling back to copies across filesystems.
+    """
+    for dirpath, _, filenames in walk_tree(source_directory):
+        target_directory = os.path.join(destination_directory, os.path.relpath(dirpath, source_directory))
+        os.makedirs(target_directory, exist_ok=True)
+        for filename in filenames:
+            source = os.path.join(dirpath, filename)
+            try:
+                os.link(source, os.path.join(target_directory, filename))
+            except OSError:
+                shutil.copy2(source, os.path.join(target_directory, filename))
+
+def publish(staging_directory, output_directory, generations_directory):
+    """
+    Makes the output directory a symlink to the staging directory by renaming a new symlink over the old one,
+    which readers see as a single atomic switch. If the output is still a plain directory, it is first moved
+    into the generations directory, leaving a window of two renames without a site.
+    """
+    if os.path.isdir(output_directory) and not os.path.islink(output_directory):
+        os.rename(output_directory, os.path.join(generations_directory, time.strftime('%Y%m%d-%H%M%S') + '-original'))
+    temporary_link = f'{output_directory}.{os.getpid()}.link'
+    os.symlink(os.path.abspath(staging_directory), temporary_link)
+    os.replace(temporary_link, output_directory)
+
+def prune_generations(generations_directory, current_directory, keep):
+    """
+    Deletes all but the newest keep generations, never touching the one being served.
+    """
+    generations = sorted(os.listdir(generations_directory))
+    for name in generations[:-keep] if keep else generations:
+        path = os.path.join(generations_directory, name)
+        if os.path.realpath(path) != os.path.realpath(current_directory):
+            shutil.rmtree(path, ignore_errors=True)
+
+def build_atomic(root_directory, html_src_directory, output_directory, keep=2, **options):
+    """
+    Builds into a fresh generation next to the output and switches the output over to it in one step, so readers
+    never see a half-built site. The generation starts as hard links to the one being served, and the incremental
+    build then replaces only the files that changed, so publishing costs about as much I/O as the changes.
+    Generations live in '<output>.generations' and the newest keep of them are kept.
+    """
+    output_directory = output_directory.rstrip(os.sep)
+    generations_directory = output_directory + '.generations'
+    os.makedirs(generations_directory, exist_ok=True)
+    staging_directory = os.path.join(generations_directory, time.strftime('%Y%m%d-%H%M%S') + f'-{os.getpid()}')
+    if os.path.isdir(output_directory):
+        link_tree(os.path.realpath(output_directory), staging_directory)
+    else:
+        os.makedirs(staging_directory)
+    try:
+        built = build(root_directory, html_src_directory, staging_directory, incremental=True, **options)
+    except BaseException:
+        shutil.rmtree(staging_directory, ignore_errors=True)
+        raise
+    publish(staging_directory, output_directory, generations_directory)
+    prune_generations(generations_directory, staging_directory, keep)
+    return built
+
+class WikiServer:
+    """
+    Development server that renders pages on demand instead of building the wiki. Rendered pages are kept in an
+    in-memory LRU of max_pages and re-rendered once the mtime of anything they were rendered from changes: the page,
+    the template and, for home pages, the directory and its descriptions. Adding, removing or renaming a page changes
+    the mtime of its directory, which rebuilds the link index and so invalidates every page.
+    styles.css is served straight from the html-source directory. Pages have no backlinks, which need the whole graph.
+    """
+    CHECK_INTERVAL = 1.0  # Seconds between two checks of the directory mtimes
+
+    def __init__(self, root_directory, html_src_directory, max_pages=256, cache=None, renderer=None):
+        self.root_directory = os.path.abspath(root_directory)
+        self.html_src_directory = html_src_directory
+        self.max_pages = max_pages
+        self.cache = cache
+        self.renderer = renderer
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.template = None
+        self.template_mtime = None
+        self.link_index = None
+        self.directory_mtimes = None
+        self.checked_at = 0.0
+        self.generation = 0
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _refresh(self):
+        """
+        Reloads the template and the link index if they changed. Returns the part of the signature shared by every page.
+        """
+        template_path = os.path.join(self.html_src_directory, 'template.html')
+        template_mtime = self._mtime(template_path)
+        if template_mtime != self.template_mtime:
+            # The template keeps pointing at plain styles.css, which is served from the html source
+            self.template = Template.load(template_path)
+            self.template_mtime = template_mtime
+        now = time.monotonic()
+        if self.link_index is None or now - self.checked_at >= self.CHECK_INTERVAL:
+            directory_mtimes = {dirpath: self._mtime(dirpath) for dirpath, _, _ in walk_tree(self.root_directory)}
+            if directory_mtimes != self.directory_mtimes:
+                self.link_index = LinkIndex(self.root_directory)
+                self.directory_mtimes = directory_mtimes
+                self.generation += 1
+            self.checked_at = now
+        return self.template_mtime, self.generation
+
+    def resolve(self, url_path):
+        """
+        Returns the Markdown file a URL path is rendered from, or None if it isn't a published page.
+        """
+        parts = [urllib.parse.unquote(part) for part in url_path.split('/') if part]
+        if any(part.startswith('.') or '/' in part or os.sep in part for part in parts):
+            return None
+        if not parts or url_path.endswith('/'):
+            parts.append('home.html')
+        if not parts[-1].endswith('.html'):
+            return None
+        file_path = os.path.join(self.root_directory, *parts[:-1], parts[-1][:-len('.html')] + '.md')
+        if not os.path.isfile(file_path) or not is_published(file_path, self.root_directory):
+            return None
+        return file_path
+
+    def render(self, file_path):
+        """
+        Returns the UTF-8 HTML of a page, from the LRU if nothing it depends on changed since it was rendered.
+        """
+        directory, file = os.path.split(file_path)
+        with self.lock:
+            shared = self._refresh()
+            template, link_index = self.template, self.link_index
+        file_stat = os.stat(file_path)
+        signature = shared + (file_stat.st_mtime_ns, file_stat.st_size)
+        if file == 'home.md':
+            ignore_list, files, subdirectories = list_directory(directory)
+            signature += (self._mtime(directory), self._mtime(os.path.join(directory, 'ignore.txt')),
+                          tuple(self._mtime(os.path.join(directory, subdir, 'description.txt')) for subdir in subdirectories))
+        with self.lock:
+            entry = self.pages.get(file_path)
+            if entry is not None and entry[0] == signature:
+                self.pages.move_to_end(file_path)
+                return entry[1]
+
+        with open(file_path, 'r') as f:
+            md_content = f.read()
+        file_info = get_file_info(file_path)
+        if file == 'home.md':
+            chunks, _ = render_home_page(directory, files, subdirectories, md_content, self.root_directory, ignore_list, template, file_info,
+                                         backlinks='', descriptions=read_descriptions(directory, subdirectories),
+                                         link_index=link_index, cache=self.cache, renderer=self.renderer)
+        else:
+            chunks, _ = render_page(directory, file, md_content, self.root_directory, template, file_info,
+                                    backlinks='', link_index=link_index, cache=self.cache, renderer=self.renderer)
+        html_content = ''.join(chunks).encode('utf-8')
+        with self.lock:
+            self.pages[file_path] = (signature, html_content)
+            self.pages.move_to_end(file_path)
+            while len(self.pages) > self.max_pages:
+                self.pages.popitem(last=False)
+        return html_content
+
+    def serve(self, host='127.0.0.1', port=8000):
+        server = http.server.ThreadingHTTPServer((host, port), WikiRequestHandler)
+        server.wiki = self
+        print(f'Serving {self.root_directory} on http://{host}:{port}/')
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+class WikiRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers GET requests of the WikiServer in server.wiki.
+    """
+    def do_GET(self):
+        wiki = self.server.wiki
+        url_path = urllib.parse.urlsplit(self.path).path
+        try:
+            if url_path == '/styles.css':
+                with open(os.path.join(wiki.html_src_directory, 'styles.css'), 'rb') as f:
+                    content, content_type = f.read(), 'text/css'
+            elif not url_path.endswith('/') and wiki.resolve(url_path + '/') is not None:
+                # Relative links on a home page only work from a URL ending in a slash
+                self.send_response(301)
+                self.send_header('Location', url_path + '/')
+                self.end_headers()
+                return
+            else:
+                file_path = wiki.resolve(url_path)
+                if file_path is None:
+                    self.send_error(404)
+                    return
+                content, content_type = wiki.render(file_path), 'text/html; charset=utf-8'
+        except OSError:
+            # Deleted while we were rendering it
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(content)
 
 if __name__ == "__main__":
-    root_directory = '/home/r0m/notes'  # Change this to your root input directory
-    html_src_directory = '/home/r0m/projects/md-wiki/html-source' # Change this to your root html source directory
-    output_directory = '/var/www/myfiles'  # Change this to your desired output directory
-    template_path = os.path.join(html_src_directory, 'template.html')
-    clear_directory(output_directory)
-    add_css(html_src_directory, output_directory)
-    process_directory(root_directory, output_directory, root_directory, template_path)
+    parser = argparse.ArgumentParser(description='Generates an HTML wiki from a directory of Markdown files.')
+    parser.add_argument('--root', default='/home/r0m/notes', help='root input directory of Markdown files')
+    parser.add_argument('--html-source', default='/home/r0m/projects/md-wiki/html-source', help='directory containing template.html and styles.css')
+    parser.add_argument('--output', default='/var/www/myfiles', help='output directory for the generated HTML')
+    parser.add_argument('--incremental', action='store_true', help='only re-render pages whose inputs changed since the last build')
+    parser.add_argument('--jobs', type=int, default=1, help='number of processes used to render pages')
+    parser.add_argument('--timings', action='store_true', help='print how long every page spent in each stage')
+    parser.add_argument('--profile', type=int, nargs='?', const=20, metavar='N',
+                        help='print how long each build phase took and the N slowest pages (default 20) by stage: '
+                             'links (create_hyperlinks), toc (generate_toc), anchors (add_anchors), markdown (convert_md_to_html), '
+                             'template (generate_html_from_template) and write')
+    parser.add_argument('--cache-dir', default=CACHE_DIRECTORY, help='directory of the rendered Markdown cache and of build state kept out of the output')
+    parser.add_argument('--cache-size', type=int, default=256, help='size limit of the rendered Markdown cache in MB')
+    parser.add_argument('--no-cache', action='store_true', help='always run the Markdown backend instead of reusing cached renders')
+    parser.add_argument('--markdown', choices=list(RENDERERS), default=DEFAULT_RENDERER,
+                        help=f'Markdown backend pages are rendered with (installed: {", ".join(available_renderers())}); '
+                             'compare them with benchmark.py markdown')
+    parser.add_argument('--no-search', action='store_true', help='do not generate the full-text search index')
+    parser.add_argument('--no-compress', action='store_true', help='do not write precompressed .gz/.br siblings of the generated files')
+    parser.add_argument('--no-backlinks', action='store_true', help='do not add "What links here" sections or write the link graph')
+    parser.add_argument('--base-url', help='public URL of the output directory, e.g. https://example.org/wiki/, to write sitemap.xml with')
+    parser.add_argument('--git-metadata', action='store_true', help='show the last commit date and author of each page instead of its mtime and owner')
+    parser.add_argument('--atomic', action='store_true', help='build into a new generation and switch the output symlink to it when done')
+    parser.add_argument('--keep-generations', type=int, default=2, help='number of generations kept by --atomic builds')
+    parser.add_argument('--watch', action='store_true', help='keep running and rebuild affected pages whenever the notes change')
+    parser.add_argument('--serve', action='store_true', help='run a local HTTP server that renders pages on demand instead of building')
+    parser.add_argument('--bind', default='127.0.0.1', help='address the --serve server listens on')
+    parser.add_argument('--port', type=int, default=8000, help='port the --serve server listens on')
+    parser.add_argument('--serve-pages', type=int, default=256, help='number of rendered pages the --serve server keeps in memory')
+    parser.add_argument('--io-threads', type=int, default=8,
+                        help='threads that list directories and read pages ahead of the build; raise it for notes on NFS, 1 reads them one at a time')
+    parser.add_argument('--poll-interval', type=float, default=0.5, help='seconds between scans in watch mode without inotify')
+    args = parser.parse_args()
+    try:
+        renderer = get_renderer(args.markdown)
+    except ValueError as e:
+        parser.error(str(e))
+    cache = None if args.no_cache else RenderCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    if args.serve:
+        try:
+            WikiServer(args.root, args.html_source, args.serve_pages, cache, renderer).serve(args.bind, args.port)
+        except KeyboardInterrupt:
+            pass
+    elif args.watch:
+        try:
+            WikiWatcher(args.root, args.html_source, args.output, args.jobs, args.poll_interval, cache, not args.no_search, args.git_metadata,
+                        not args.no_compress, not args.no_backlinks, args.base_url, renderer, args.io_threads, args.cache_dir).run()
+        except KeyboardInterrupt:
+            pass
+    elif args.atomic:
+        build_atomic(args.root, args.html_source, args.output, args.keep_generations, jobs=args.jobs, timings=args.timings,
+                     cache=cache, search=not args.no_search, git=args.git_metadata, compress=not args.no_compress, profile=args.profile,
+                     backlinks=not args.no_backlinks, base_url=args.base_url, renderer=renderer, io_threads=args.io_threads, cache_dir=args.cache_dir)
+    else:
+        build(args.root, args.html_source, args.output, args.incremental, args.jobs, args.timings, cache, not args.no_search, args.git_metadata,
+              not args.no_compress, args.profile, not args.no_backlinks, args.base_url, renderer, args.io_threads, args.cache_dir)
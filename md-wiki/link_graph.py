@@ -0,0 +1,130 @@
+import os
+import json
+from atomic_files import write_file, read_json
+
+GRAPH_NAME = 'graph.json'
+STATE_NAME = '.link-graph.json'
+
+class LinkGraph:
+    """
+    Graph of the links between the pages of a generated wiki, with every page numbered by a compact integer id.
+    graph.json in the output maps ids to [url, title] under "pages" and to the sorted ids of the pages they link to
+    under "links", with null for freed ids. .link-graph.json remembers the signature of every page's source file and
+    the digest of the link index the links were found with, so a later build only rescans the pages that changed.
+    Ids are kept across builds and freed ids are reused, so the graph stays dense. Nothing is written when
+    an update changed nothing.
+    """
+    def __init__(self, output_directory):
+        self.output_directory = output_directory
+        self.pages = []
+        self.links = []
+        self.signatures = []
+        self.links_digest = None
+        self.dirty = True  # Whether the graph changed since it was read or saved
+        graph = self._read(GRAPH_NAME)
+        state = self._read(STATE_NAME)
+        if graph is not None and state is not None and len(graph['pages']) == len(state['signatures']):
+            self.pages = graph['pages']
+            self.links = graph['links']
+            self.signatures = state['signatures']
+            self.links_digest = state['links_digest']
+            self.dirty = False
+        self.ids = {page[0]: page_id for page_id, page in enumerate(self.pages) if page is not None}
+        self.free_ids = [page_id for page_id, page in enumerate(self.pages) if page is None]
+        self.sources = self._invert()
+
+    def _read(self, name):
+        return read_json(os.path.join(self.output_directory, name), 'link graph file')
+
+    def _write(self, name, data):
+        path = os.path.join(self.output_directory, name)
+        write_file(path, json.dumps(data, separators=(',', ':')))
+        return path
+
+    def _invert(self):
+        """
+        Returns a list holding, for every id, the ids of the pages that link to it.
+        """
+        sources = [[] for _ in self.pages]
+        for page_id, targets in enumerate(self.links):
+            for target in targets or ():
+                sources[target].append(page_id)
+        return sources
+
+    def _backlink_urls(self):
+        return {self.pages[page_id][0]: tuple(sorted(self.pages[source][0] for source in sources))
+                for page_id, sources in enumerate(self.sources) if sources}
+
+    def update(self, pages, links_digest, find_targets, map_targets=map):
+        """
+        Brings the graph up to date with the published pages, given as (url, title, signature) tuples.
+        find_targets(url) returns the urls a page links to. It is only called for pages that are new, whose title or
+        signature changed, or for every page when links_digest, the digest of the link index, changed.
+        map_targets(find_targets, urls) maps it over the pages to rescan and must keep their order, like map does.
+        Returns the set of urls whose backlinks changed and the number of pages that were rescanned.
+        """
+        before = self._backlink_urls()
+        published = {url for url, _, _ in pages}
+        freed = set()
+        for url in [url for url in self.ids if url not in published]:
+            page_id = self.ids.pop(url)
+            self.pages[page_id] = self.links[page_id] = self.signatures[page_id] = None
+            freed.add(page_id)
+        if freed or links_digest != self.links_digest:
+            self.dirty = True
+        if freed:
+            # Drop links to freed ids before they are handed out again
+            for page_id, targets in enumerate(self.links):
+                if targets and not freed.isdisjoint(targets):
+                    self.links[page_id] = [target for target in targets if target not in freed]
+            self.free_ids.extend(sorted(freed, reverse=True))
+
+        rescan = []
+        for url, title, signature in pages:
+            page_id = self.ids.get(url)
+            if page_id is None:
+                if self.free_ids:
+                    page_id = self.free_ids.pop()
+                else:
+                    page_id = len(self.pages)
+                    self.pages.append(None)
+                    self.links.append(None)
+                    self.signatures.append(None)
+                self.ids[url] = page_id
+                rescan.append(page_id)
+            elif links_digest != self.links_digest or self.signatures[page_id] != list(signature) or self.pages[page_id][1] != title:
+                rescan.append(page_id)
+            if self.pages[page_id] != [url, title] or self.signatures[page_id] != list(signature):
+                self.dirty = True
+            self.pages[page_id] = [url, title]
+            self.signatures[page_id] = list(signature)
+
+        urls = [self.pages[page_id][0] for page_id in rescan]
+        for page_id, targets in zip(rescan, map_targets(find_targets, urls)):
+            self.links[page_id] = sorted({self.ids[target] for target in targets if target in self.ids} - {page_id})
+        self.links_digest = links_digest
+        self.sources = self._invert()
+
+        after = self._backlink_urls()
+        changed = {url for url in before.keys() | after.keys() if before.get(url) != after.get(url)}
+        return changed, len(rescan)
+
+    def backlinks(self, url):
+        """
+        Returns the (url, title) of every page linking to the page, sorted by title.
+        """
+        page_id = self.ids.get(url)
+        if page_id is None:
+            return []
+        return sorted(((self.pages[source][0], self.pages[source][1]) for source in self.sources[page_id]), key=lambda page: (page[1], page[0]))
+
+    def save(self):
+        """
+        Writes graph.json and the state of the next update, unless nothing changed since the graph was read or saved.
+        Returns the paths of the files served to browsers that were written, i.e. graph.json or nothing.
+        """
+        if not self.dirty:
+            return []
+        self._write(STATE_NAME, {'links_digest': self.links_digest, 'signatures': self.signatures})
+        self.dirty = False
+        return [self._write(GRAPH_NAME, {'pages': self.pages, 'links': self.links})]
@@ -0,0 +1,129 @@
+import json
+import functools
+import importlib.metadata
+import markdown2
+
+# The other backends are optional, a build only needs the one it renders with
+try:
+    import mistune
+except ImportError:
+    mistune = None
+
+try:
+    import markdown_it
+except ImportError:
+    markdown_it = None
+
+try:
+    import cmarkgfm
+except ImportError:
+    cmarkgfm = None
+
+DEFAULT_RENDERER = 'markdown2'
+MARKDOWN_EXTRAS = ['fenced-code-blocks']
+
+class MarkdownRenderer:
+    """
+    A Markdown backend that turns the Markdown of a page into an HTML fragment.
+    The hyperlinks and header anchors are put into the Markdown as <a> tags before it is rendered, so every backend
+    has to pass inline HTML through untouched. Headers and fenced code blocks are found by analyze_markdown with
+    markdown2's rules, so the TOC and anchors are the same whichever backend renders the page.
+    key names the backend, its version and its options. It is part of every render cache key and build digest,
+    so switching backends or upgrading one never serves stale HTML.
+    Renderers only hold strings, so they can be sent to render worker processes.
+    """
+    name = None
+    distribution = None  # Name of the package the backend is installed as
+    module = None
+    options = None
+
+    def __init__(self):
+        if not self.available():
+            raise ValueError(f'The {self.name} Markdown backend needs the {self.distribution} package')
+        try:
+            self.version = importlib.metadata.version(self.distribution)
+        except importlib.metadata.PackageNotFoundError:
+            self.version = getattr(self.module, '__version__', 'unknown')
+        self.key = f'{self.name} {self.version}\n{json.dumps(self.options)}'
+
+    @classmethod
+    def available(cls):
+        return cls.module is not None
+
+    def render(self, md_content):
+        raise NotImplementedError
+
+class Markdown2Renderer(MarkdownRenderer):
+    """
+    markdown2, pure Python. The default, and what the wiki has always been rendered with.
+    """
+    name = 'markdown2'
+    distribution = 'markdown2'
+    module = markdown2
+    options = MARKDOWN_EXTRAS
+
+    def render(self, md_content):
+        return markdown2.markdown(md_content, extras=MARKDOWN_EXTRAS)
+
+@functools.lru_cache(maxsize=None)
+def _mistune_parser():
+    return mistune.create_markdown(escape=False)
+
+class MistuneRenderer(MarkdownRenderer):
+    """
+    mistune, pure Python but several times faster than markdown2.
+    """
+    name = 'mistune'
+    distribution = 'mistune'
+    module = mistune
+    options = {'escape': False}
+
+    def render(self, md_content):
+        return _mistune_parser()(md_content)
+
+@functools.lru_cache(maxsize=None)
+def _markdown_it_parser():
+    return markdown_it.MarkdownIt('commonmark', {'html': True})
+
+class MarkdownItRenderer(MarkdownRenderer):
+    """
+    markdown-it-py, a pure Python CommonMark implementation.
+    """
+    name = 'markdown-it'
+    distribution = 'markdown-it-py'
+    module = markdown_it
+    options = {'preset': 'commonmark', 'html': True}
+
+    def render(self, md_content):
+        return _markdown_it_parser().render(md_content)
+
+class CmarkRenderer(MarkdownRenderer):
+    """
+    cmark-gfm, GitHub's CommonMark implementation in C. By far the fastest backend.
+    """
+    name = 'cmark'
+    distribution = 'cmarkgfm'
+    module = cmarkgfm
+    options = {'unsafe': True}
+
+    def render(self, md_content):
+        # Without the unsafe option cmark replaces inline HTML with a comment
+        return cmarkgfm.markdown_to_html(md_content, options=cmarkgfm.cmark.Options.CMARK_OPT_UNSAFE)
+
+RENDERERS = {renderer.name: renderer for renderer in [Markdown2Renderer, MistuneRenderer, MarkdownItRenderer, CmarkRenderer]}
+
+@functools.lru_cache(maxsize=None)
+def get_renderer(name=DEFAULT_RENDERER):
+    """
+    Returns the renderer of a backend. Raises ValueError if the backend is unknown or its package isn't installed.
+    """
+    renderer_class = RENDERERS.get(name)
+    if renderer_class is None:
+        raise ValueError(f'Unknown Markdown backend {name}, expected one of {", ".join(RENDERERS)}')
+    return renderer_class()
+
+def available_renderers():
+    """
+    Returns the names of the backends whose packages are installed.
+    """
+    return [name for name, renderer_class in RENDERERS.items() if renderer_class.available()]
@@ -0,0 +1,351 @@
+import os
+import re
+import sys
+import json
+import shutil
+import time
+import hashlib
+from atomic_files import write_file, read_json
+
+WORD = re.compile(r'\w+')
+SHARD_COUNT = 64
+FLUSH_POSITIONS = 250000  # Word positions indexed pages can hold in memory before they are written to the shards
+STATE_LIFETIME = 30 * 24 * 60 * 60  # Seconds an unused search index state is kept
+
+def tokenize(text):
+    """
+    Splits text into lowercase word terms.
+    """
+    return WORD.findall(text.lower())
+
+def shard_of(term, shard_count):
+    """
+    Returns the shard a term lives in: 32-bit FNV-1a of its UTF-8 bytes modulo the shard count.
+    It is a few lines of JavaScript, so the browser can work out which shards a query needs.
+    """
+    value = 0x811c9dc5
+    for byte in term.encode('utf-8'):
+        value = ((value ^ byte) * 0x01000193) & 0xffffffff
+    return value % shard_count
+
+def encode_postings(postings):
+    """
+    Packs a {page_id: [positions]} dictionary into a flat list of numbers for a shard file:
+    for every page in id order, the id delta, the number of positions, then the position deltas.
+    """
+    flat = []
+    last_id = 0
+    for page_id in sorted(postings):
+        positions = postings[page_id]
+        flat.append(page_id - last_id)
+        flat.append(len(positions))
+        last_position = 0
+        for position in positions:
+            flat.append(position - last_position)
+            last_position = position
+        last_id = page_id
+    return flat
+
+def decode_postings(flat):
+    """
+    Unpacks a flat list written by encode_postings.
+    """
+    postings = {}
+    page_id = 0
+    i = 0
+    while i < len(flat):
+        page_id += flat[i]
+        count = flat[i + 1]
+        i += 2
+        positions = []
+        position = 0
+        for delta in flat[i:i + count]:
+            position += delta
+            positions.append(position)
+        postings[page_id] = positions
+        i += count
+    return postings
+
+class SearchIndexWriter:
+    """
+    Maintains the full-text index of a generated wiki in the 'search' directory of the output.
+    The index is an inverted index from terms to the pages and word positions they appear at, split into
+    shard-NN.json files by shard_of() so a query only loads the shards of its terms. pages.json maps page ids
+    to [url, title], with null for freed ids. The build state remembers the digest and terms of every page, so a
+    later build only rewrites the shards touched by pages that changed. It is about as large as the index and
+    names every page, so it is kept in the state directory instead of the served output, in a file named by its
+    digest, which meta.json records. An index whose state file is missing is rebuilt from scratch.
+    The postings of added pages wait in memory until about flush_positions word positions have piled up, then they
+    are spilled to a segment file per shard in the state directory. finish() merges every shard touched by the build
+    with its segments and removals, one shard at a time, so a build holds at most that many positions and a single
+    decoded shard in memory whatever the size of the notes, and still reads and writes every shard once.
+    """
+    def __init__(self, output_directory, state_directory, shard_count=SHARD_COUNT, flush_positions=FLUSH_POSITIONS):
+        self.directory = os.path.join(output_directory, 'search')
+        self.state_directory = state_directory
+        self.shard_count = shard_count
+        self.pages = []
+        self.state = {}
+        self.state_name = None
+        self.changed = False
+        self.flush_positions = flush_positions
+        self.added = {}  # {shard_id: {term: {page_id: positions}}} of the batch being indexed
+        self.batch = 0  # Number of batches spilled since the last finish()
+        self.segments = {}  # {shard_id: {batch: path}} of the spilled batches
+        self.removed = {}  # {shard_id: [(batch, term, page_id)]}, applied before the additions of that batch
+        self.pending_positions = 0
+        self.seen = set()
+        self.updated = 0
+        self.written = []  # Files served to browsers that the last finish() rewrote
+        meta = self._read('meta.json')
+        state = None
+        if meta is not None and meta.get('shards') == shard_count and meta.get('state'):
+            state = self._read_state(meta['state'])
+        if state is not None:
+            self.pages = self._read('pages.json') or []
+            for entry in state.values():
+                entry[2] = [sys.intern(term) for term in entry[2]]
+            self.state = state
+            self.state_name = meta['state']
+        else:
+            # Shards written with another shard count, or without their state, are unusable
+            self.changed = True
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.startswith('shard-') or name == 'state.json':  # Where older builds kept the state
+                        os.unlink(os.path.join(self.directory, name))
+        self.free_ids = [page_id for page_id, page in enumerate(self.pages) if page is None]
+
+    def _read(self, name):
+        return read_json(os.path.join(self.directory, name), 'search index file')
+
+    def _read_state(self, name):
+        path = os.path.join(self.state_directory, name)
+        state = read_json(path, 'search index state')
+        if state is not None:
+            os.utime(path)  # Keeps it from expiring
+        return state
+
+    def _write_state(self):
+        """
+        Stores the build state under its digest and returns that name. Drops the previous state, and the states of
+        other indexes that no build has used for STATE_LIFETIME seconds.
+        """
+        data = json.dumps(self.state, separators=(',', ':'), sort_keys=True)
+        name = hashlib.sha1(data.encode('utf-8')).hexdigest() + '.json'
+        os.makedirs(self.state_directory, exist_ok=True)
+        write_file(os.path.join(self.state_directory, name), data)
+        expired = time.time() - STATE_LIFETIME
+        for entry in os.scandir(self.state_directory):
+            try:
+                if (entry.name == self.state_name and entry.name != name) or (entry.name.endswith('.json') and entry.stat().st_mtime < expired):
+                    os.unlink(entry.path)
+                elif entry.name.startswith('spill-') and entry.stat().st_mtime < expired:
+                    shutil.rmtree(entry.path)  # Left behind by a build that crashed
+            except OSError:
+                pass
+        return name
+
+    def _write(self, name, data):
+        """
+        Writes a JSON file of the index and returns its path.
+        """
+        path = os.path.join(self.directory, name)
+        # json.dumps uses the C encoder, json.dump streams through the much slower Python one
+        write_file(path, json.dumps(data, separators=(',', ':'), sort_keys=True))
+        return path
+
+    def _spill_directory(self):
+        return os.path.join(self.state_directory, f'spill-{os.getpid()}')
+
+    def _spill(self):
+        """
+        Writes the postings of the batch being indexed to one segment file per shard and starts the next batch.
+        """
+        os.makedirs(self._spill_directory(), exist_ok=True)
+        for shard_id, terms in self.added.items():
+            path = os.path.join(self._spill_directory(), f'{shard_id:02d}-{self.batch}.json')
+            write_file(path, json.dumps({term: encode_postings(postings) for term, postings in terms.items() if postings}, separators=(',', ':')))
+            self.segments.setdefault(shard_id, {})[self.batch] = path
+        self.added = {}
+        self.batch += 1
+        self.pending_positions = 0
+
+    def _merge(self, shard_id):
+        """
+        Applies the removals and the spilled and waiting additions of the build to a shard, in the order they were
+        made, writes it and returns its path. Only the terms they touch are decoded.
+        """
+        name = f'shard-{shard_id:02d}.json'
+        encoded = self._read(name) or {}
+        shard = {}
+
+        def postings(term):
+            if term not in shard:
+                shard[term] = decode_postings(encoded.pop(term, []))
+            return shard[term]
+
+        removed = self.removed.pop(shard_id, [])
+        segments = self.segments.pop(shard_id, {})
+        for batch in range(self.batch + 1):
+            for removal_batch, term, page_id in removed:
+                if removal_batch == batch:
+                    postings(term).pop(page_id, None)
+            if batch in segments:
+                additions = {term: decode_postings(flat) for term, flat in (read_json(segments[batch], 'search index segment') or {}).items()}
+            elif batch == self.batch:
+                additions = self.added.pop(shard_id, {})
+            else:
+                continue
+            for term, term_postings in additions.items():
+                if term_postings:
+                    postings(term).update(term_postings)
+        encoded.update((term, encode_postings(term_postings)) for term, term_postings in shard.items() if term_postings)
+        return self._write(name, encoded)
+
+    def add_page(self, url, title, text):
+        """
+        Indexes a page, or re-indexes it if its text changed since the last build.
+        """
+        self.seen.add(url)
+        digest = hashlib.sha1(f'{title}\n{text}'.encode('utf-8')).hexdigest()
+        entry = self.state.get(url)
+        if entry is not None and entry[1] == digest:
+            return
+        if entry is not None:
+            # Frees the page's id, which the next line takes back
+            self.remove_page(url)
+        if self.free_ids:
+            page_id = self.free_ids.pop()
+        else:
+            page_id = len(self.pages)
+            self.pages.append(None)
+
+        positions = {}
+        terms = tokenize(text)
+        for position, term in enumerate(terms):
+            positions.setdefault(term, []).append(position)
+        # The state lists the terms of every page, so every page shares one copy of each term
+        positions = {sys.intern(term): term_positions for term, term_positions in positions.items()}
+        for term, term_positions in positions.items():
+            self.added.setdefault(shard_of(term, self.shard_count), {}).setdefault(term, {})[page_id] = term_positions
+        self.pages[page_id] = [url, title]
+        self.state[url] = [page_id, digest, sorted(positions)]
+        self.updated += 1
+        self.changed = True
+        self.pending_positions += len(terms)
+        if self.pending_positions >= self.flush_positions:
+            self._spill()
+
+    def remove_page(self, url):
+        """
+        Drops a page and its postings from the index.
+        """
+        entry = self.state.pop(url, None)
+        if entry is None:
+            return
+        page_id, _, terms = entry
+        for term in terms:
+            shard_id = shard_of(term, self.shard_count)
+            # The page may be in the batch being indexed. If it was spilled, the removal is applied after its batch.
+            postings = self.added.get(shard_id, {}).get(term)
+            if postings is not None:
+                postings.pop(page_id, None)
+            self.removed.setdefault(shard_id, []).append((self.batch, term, page_id))
+        self.pages[page_id] = None
+        self.free_ids.append(page_id)
+        self.changed = True
+
+    def finish(self, prune=True):
+        """
+        Writes the shards that changed, and pages.json, meta.json and the state if any page was added, changed
+        or removed. With prune, pages that weren't added during this build are removed first.
+        """
+        if prune:
+            for url in [url for url in self.state if url not in self.seen]:
+                self.remove_page(url)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.written = [self._merge(shard_id) for shard_id in sorted(self.added.keys() | self.removed.keys() | self.segments.keys())]
+        if self.batch:
+            shutil.rmtree(self._spill_directory(), ignore_errors=True)
+            self.batch = 0
+        self.pending_positions = 0
+        if self.changed:
+            self.written.append(self._write('pages.json', self.pages))
+            self.state_name = self._write_state()
+            self.written.append(self._write('meta.json', {'shards': self.shard_count, 'state': self.state_name}))
+            self.changed = False
+        self.seen.clear()
+        updated, self.updated = self.updated, 0
+        return updated
+
+class SearchIndex:
+    """
+    Read-only view of an index written by SearchIndexWriter. Shards are loaded on first use and kept.
+    """
+    def __init__(self, output_directory):
+        self.directory = os.path.join(output_directory, 'search')
+        with open(os.path.join(self.directory, 'meta.json'), 'r') as f:
+            self.shard_count = json.load(f)['shards']
+        with open(os.path.join(self.directory, 'pages.json'), 'r') as f:
+            self.pages = json.load(f)
+        self.shards = {}
+
+    def postings(self, term):
+        """
+        Returns the {page_id: positions} dictionary of a single term.
+        """
+        shard_id = shard_of(term, self.shard_count)
+        shard = self.shards.get(shard_id)
+        if shard is None:
+            path = os.path.join(self.directory, f'shard-{shard_id:02d}.json')
+            shard = {}
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    shard = json.load(f)
+            self.shards[shard_id] = shard
+        flat = shard.get(term)
+        return decode_postings(flat) if flat else {}
+
+    def search(self, query, limit=10):
+        """
+        Returns up to limit (url, title, score) results for pages containing every term of the query, best first.
+        A query in double quotes only matches pages where its terms appear next to each other in that order.
+        The score is the number of times the terms, or the phrase, occur on the page.
+        """
+        query = query.strip()
+        phrase = len(query) > 1 and query.startswith('"') and query.endswith('"')
+        terms = tokenize(query)
+        if not terms:
+            return []
+        term_postings = [self.postings(term) for term in terms]
+        page_ids = set(term_postings[0])
+        for postings in term_postings[1:]:
+            page_ids &= postings.keys()
+
+        scores = {}
+        for page_id in page_ids:
+            if phrase:
+                # Count the positions where each following term appears right after the previous one
+                starts = set(term_postings[0][page_id])
+                for offset, postings in enumerate(term_postings[1:], 1):
+                    starts &= {position - offset for position in postings[page_id]}
+                score = len(starts)
+            else:
+                score = sum(len(postings[page_id]) for postings in term_postings)
+            if score:
+                scores[page_id] = score
+
+        ranked = sorted(scores, key=lambda page_id: (-scores[page_id], page_id))[:limit]
+        return [(self.pages[page_id][0], self.pages[page_id][1], scores[page_id]) for page_id in ranked]
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Searches the index of a generated wiki.')
+    parser.add_argument('output', help='output directory of the wiki')
+    parser.add_argument('query', help='words to search for, or a "quoted phrase"')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+    for url, title, score in SearchIndex(args.output).search(args.query, args.limit):
+        print(f'{score:>5}  {title}  ({url})')